@@ -15,23 +15,35 @@ import pandas as pd
 from plotly import graph_objects as go
 import pmdarima as pm
 
+COLUMNS = ["id", "name", "set_name", "border_color", "utc", "usd", "usd_foil", "usd_etched"]
+
+@st.cache_resource
+def get_db():
+    # Shared by all sessions, each query checks out one of the pooled readers
+    return ETGDatabase(readers=4)
+
 @st.cache_data
-def load_data(what: list[str]):
-    db = ETGDatabase()
-    df = db.get_tables(what)
+def load_card(card: str):
+    db = get_db()
+    df = db.get_tables(["Cards", "Prices"], columns=COLUMNS, name=card)
     return df
 
 @st.cache_data
-def get_all_card_names(df: pd.DataFrame):
-    return list(sorted(df["name"].unique()))
+def search_card_names(text: str):
+    db = get_db()
+    df = db.search_cards(text, limit=50)
+    return list(df["name"])
 
 def main() -> int:
     st.set_page_config(layout='wide')
-    df = load_data(["Cards", "Prices"])
     page = st.sidebar.selectbox("What would you like to see", ("MTG Prices", ))
     
     if page == "MTG Prices":
-        cards = st.sidebar.multiselect("Which cards would you like to look at", get_all_card_names(df))
+        # Options come from the search index, keeping whatever is already selected
+        search = st.sidebar.text_input("Search cards")
+        options = search_card_names(search) if search else []
+        options += [card for card in st.session_state.get("cards", []) if card not in options]
+        cards = st.sidebar.multiselect("Which cards would you like to look at", options, key="cards")
         
         fig = go.Figure(
             layout=dict(
@@ -40,7 +52,7 @@ def main() -> int:
             )
         )
         for card in cards:
-            sub_table = df[df["name"] == card]
+            sub_table = load_card(card)
             st.dataframe(sub_table)
             for card_id in sub_table["id"].unique():
                 small_table = sub_table[sub_table["id"] == card_id]
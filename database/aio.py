@@ -0,0 +1,134 @@
+"""Asyncio interface to ETGDatabase, running queries on pooled readers in a bounded executor."""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Sequence
+
+import pandas as pd
+
+from database.cache import QueryCache
+from database.db import ETGDatabase
+from database.pool import READERS
+
+
+class AsyncETGDatabase:
+    """Awaitable query/get_tables/date_range for event loops.
+
+    Each call runs on one of `workers` threads with its own pooled reader, so several can be
+    awaited together with asyncio.gather. Cancelling a call (or its timeout running out) interrupts
+    the SQL it's running rather than leaving it to finish in the background.
+    """
+
+    def __init__(
+        self,
+        database: str | None = None,
+        archive_path: str | None = None,
+        cache: QueryCache | None = None,
+        readers: int = READERS,
+        workers: int | None = None,
+        timeout: float | None = None,
+    ):
+        self.db = ETGDatabase(database, archive_path, cache, readers=readers)
+
+        # More workers than readers would only queue on the pool
+        self._executor = ThreadPoolExecutor(max_workers=workers or readers, thread_name_prefix="etg-db")
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.db.pool.close()
+
+    # Querying ------------------------
+
+    async def query(
+        self, query: str, params: Sequence | dict | None = None, timeout: float | None = None
+    ) -> pd.DataFrame:
+        """See ETGDatabase.query, raises TimeoutError after timeout seconds (default self.timeout)"""
+        return await self._run(lambda: self.db.query(query, params), timeout)
+
+    async def get_table(
+        self, table_name: str, columns: list[str] | None = None, timeout: float | None = None, **filters
+    ) -> pd.DataFrame:
+        """See ETGDatabase.get_table"""
+        return await self._run(lambda: self.db.get_table(table_name, columns, **filters), timeout)
+
+    async def get_tables(
+        self,
+        table_names: list[str],
+        columns: list[str] | None = None,
+        start: str | None = None,
+        end: str | None = None,
+        timeout: float | None = None,
+        **filters,
+    ) -> pd.DataFrame:
+        """See ETGDatabase.get_tables"""
+        return await self._run(lambda: self.db.get_tables(table_names, columns, start, end, **filters), timeout)
+
+    async def date_range(
+        self,
+        start: str,
+        end: str | None = None,
+        columns: list[str] | None = None,
+        timeout: float | None = None,
+        **filters,
+    ) -> pd.DataFrame:
+        """See ETGDatabase.date_range"""
+        return await self._run(lambda: self.db.date_range(start, end, columns, **filters), timeout)
+
+    async def latest_date(self, timeout: float | None = None) -> str | None:
+        """See ETGDatabase.latest_date"""
+        return await self._run(self.db.latest_date, timeout)
+
+    def pool_stats(self) -> dict[str, int | float]:
+        return self.db.pool_stats()
+
+    # Helpers -------------------------
+
+    async def _run(self, fn: Callable, timeout: float | None):
+        call = _Call(self.db, fn)
+        future = asyncio.get_running_loop().run_in_executor(self._executor, call.run)
+
+        try:
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            call.cancel()
+            raise
+
+
+class _Call:
+    """Runs fn with a pinned reader that can be interrupted from the event loop thread"""
+
+    def __init__(self, db: ETGDatabase, fn: Callable):
+        self.db = db
+        self.fn = fn
+
+        self._lock = threading.Lock()
+        self._conn = None
+        self._cancelled = False
+
+    def run(self):
+        with self.db.reader() as conn:
+            with self._lock:
+                if self._cancelled:
+                    raise asyncio.CancelledError()
+                self._conn = conn
+
+            try:
+                return self.fn()
+            finally:
+                # Cleared before the reader goes back, so a late cancel can't interrupt its next user
+                with self._lock:
+                    self._conn = None
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._conn is not None:
+                self._conn.interrupt()
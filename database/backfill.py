@@ -0,0 +1,89 @@
+"""Rebuilds price history from saved JSON snapshots (see scry.save_json)."""
+
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from database.db import ETGDatabase
+from database.online import scry
+from database.tables import extract
+
+
+def backfill(db: ETGDatabase, path: str, workers: int | None = None):
+    """Loads every snapshot in path into db in date order.
+
+    Snapshots are parsed in a pool of worker processes while this process writes them one
+    at a time. Each loaded snapshot is checkpointed in the Backfill table, so rerunning an
+    interrupted backfill skips what was already loaded.
+    """
+    workers = workers or os.cpu_count() or 1
+
+    c = db.conn.cursor()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS Backfill (
+            fname TEXT,
+            utc TEXT,
+            PRIMARY KEY (fname)
+        )
+    """)
+    db.conn.commit()
+
+    done = {row[0] for row in c.execute("SELECT fname FROM Backfill")}
+    latest = db.latest_date()
+
+    # Find snapshots to load, oldest first
+    todo = []
+    for fname, date in find_snapshots(path):
+        if fname in done:
+            continue
+        if latest is not None and date < latest:
+            print(f"backfill: Skipping '{fname}', it's older than the latest loaded day ({latest})")
+            continue
+        todo.append((fname, date))
+
+    print(f"backfill: {len(todo)} snapshots to load ({len(done)} already loaded) with {workers} workers...")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Keep a bounded number of parsed snapshots in flight, results come back in order
+        pending = deque()
+        snapshots = iter(todo)
+
+        def submit():
+            for fname, date in snapshots:
+                pending.append((fname, date, pool.submit(parse_snapshot, os.path.join(path, fname), date)))
+                if len(pending) >= 2 * workers:
+                    break
+
+        submit()
+        while pending:
+            fname, date, future = pending.popleft()
+            columns = future.result()
+            submit()
+
+            print(f"backfill: Loading '{fname}' ({date})...")
+            db.update_extracted([columns], date)
+
+            c.execute("INSERT OR REPLACE INTO Backfill (fname, utc) VALUES (?, ?)", (fname, date))
+            db.conn.commit()
+
+    c.close()
+
+    print(f"backfill: Done in {time.perf_counter() - start:.1f}s.")
+
+def find_snapshots(path: str) -> list[tuple[str, str]]:
+    """Lists (filename, YYYY-MM-DD) of the json snapshots in path, oldest first"""
+    snapshots = []
+    for fname in sorted(os.listdir(path)):
+        match = re.search(r"\d{4}-\d{2}-\d{2}", fname)
+        if fname.endswith(".json") and match:
+            snapshots.append((fname, match.group()))
+
+    # Stable sort keeps same-day snapshots in filename (timestamp) order
+    return sorted(snapshots, key=lambda snapshot: snapshot[1])
+
+def parse_snapshot(fpath: str, date: str) -> dict[str, dict[str, list]]:
+    """Parses a snapshot straight into extracted columns, runs in a worker process"""
+    return extract.extract(scry.read_bulk_file(fpath), date)
@@ -0,0 +1,252 @@
+"""Query result cache keyed on database version, SQL and params."""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    DISK_FORMAT = "parquet"
+except ImportError:
+    DISK_FORMAT = "pickle"
+
+CACHE_PATH = "data/cache/query/"
+MEMORY_BYTES = 256 * 1024 * 1024
+DISK_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class QueryCache:
+    """Two tier (in-process LRU, then on-disk) cache of query results.
+
+    Entries are keyed on the database file, its version (size/mtime of the file and WAL),
+    the whitespace normalized SQL and the params, so any commit makes older entries unreachable.
+    Both tiers evict least recently used entries once over their size in bytes.
+    """
+
+    def __init__(
+        self,
+        path: str | None = CACHE_PATH,
+        memory_bytes: int = MEMORY_BYTES,
+        disk_bytes: int = DISK_BYTES,
+    ):
+        # No path means memory only
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(
+        self, database: str, query: str, params, load: Callable[[], pd.DataFrame]
+    ) -> pd.DataFrame:
+        """Returns the cached result of query on database, calling load on a miss"""
+        version = database_version(database)
+
+        # Nothing to key on for in-memory databases
+        if version is None:
+            return load()
+
+        key = self._key(database, version, query, params)
+
+        df = self._get_memory(key)
+        if df is None:
+            df = self._get_disk(key)
+            if df is not None:
+                self._put_memory(key, df)
+        if df is not None:
+            return df.copy()
+
+        with self._lock:
+            self.misses += 1
+
+        df = load()
+        self._put_memory(key, df)
+        self._put_disk(key, df)
+
+        return df.copy()
+
+    def invalidate(self, database: str | None = None):
+        """Drops all entries for database (or every entry if None)"""
+        prefix = None if database is None else _digest(os.path.abspath(database))
+
+        with self._lock:
+            for key in list(self._memory):
+                if prefix is None or key.startswith(prefix):
+                    self._memory_size -= self._memory.pop(key)[1]
+
+        for fname in self._disk_files():
+            if prefix is None or os.path.basename(fname).startswith(prefix):
+                _remove(fname)
+
+    def stats(self) -> dict[str, int | float]:
+        """Hit/miss counts, hit rate and tier sizes in bytes"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "disk_bytes": sum(os.path.getsize(fname) for fname in self._disk_files()),
+            }
+
+    # Memory tier ---------------------
+
+    def _get_memory(self, key: str) -> pd.DataFrame | None:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+
+            self._memory.move_to_end(key)
+            self.hits += 1
+
+            return entry[0]
+
+    def _put_memory(self, key: str, df: pd.DataFrame):
+        size = int(df.memory_usage(deep=True).sum())
+
+        # Results bigger than the whole tier only go to disk
+        if size > self.memory_bytes:
+            return
+
+        with self._lock:
+            if key in self._memory:
+                return
+
+            self._memory[key] = (df, size)
+            self._memory_size += size
+
+            while self._memory_size > self.memory_bytes:
+                _, (_, old_size) = self._memory.popitem(last=False)
+                self._memory_size -= old_size
+                self.evictions += 1
+
+    # Disk tier -----------------------
+
+    def _get_disk(self, key: str) -> pd.DataFrame | None:
+        fname = self._disk_file(key)
+        if fname is None or not os.path.exists(fname):
+            return None
+
+        try:
+            df = pd.read_parquet(fname) if DISK_FORMAT == "parquet" else pd.read_pickle(fname)
+        except Exception:
+            # Partially written or corrupt entries are just misses
+            _remove(fname)
+            return None
+
+        # Reads refresh the entry for eviction
+        try:
+            os.utime(fname)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+            self.disk_hits += 1
+
+        return df
+
+    def _put_disk(self, key: str, df: pd.DataFrame):
+        fname = self._disk_file(key)
+        if fname is None:
+            return
+
+        # Write to temp file first so readers never see half an entry
+        tmp = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if DISK_FORMAT == "parquet":
+                df.to_parquet(tmp)
+            else:
+                df.to_pickle(tmp)
+            os.replace(tmp, fname)
+        except Exception:
+            _remove(tmp)
+            return
+
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = [(os.path.getmtime(fname), os.path.getsize(fname), fname) for fname in self._disk_files()]
+        total = sum(size for _, size, _ in files)
+
+        for _, size, fname in sorted(files):
+            if total <= self.disk_bytes:
+                break
+
+            _remove(fname)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def _disk_file(self, key: str) -> str | None:
+        if self.path is None:
+            return None
+
+        return os.path.join(self.path, f"{key}.{DISK_FORMAT}")
+
+    def _disk_files(self) -> list[str]:
+        if self.path is None:
+            return []
+
+        return [
+            os.path.join(self.path, fname)
+            for fname in os.listdir(self.path)
+            if fname.endswith(".parquet") or fname.endswith(".pickle")
+        ]
+
+    @staticmethod
+    def _key(database: str, version: tuple, query: str, params) -> str:
+        # Database digest first so entries can be invalidated by prefix
+        if isinstance(params, dict):
+            params = sorted(params.items())
+        elif params is not None:
+            params = list(params)
+
+        query = " ".join(query.split())
+
+        return _digest(os.path.abspath(database)) + _digest(repr((version, query, params)))
+
+
+def database_version(database: str) -> tuple | None:
+    """Size and modification time of the database file and its WAL, None if there is no file"""
+    try:
+        stat = os.stat(database)
+    except (OSError, TypeError):
+        return None
+
+    version = (stat.st_size, stat.st_mtime_ns)
+    try:
+        wal = os.stat(database + "-wal")
+        version += (wal.st_size, wal.st_mtime_ns)
+    except OSError:
+        pass
+
+    return version
+
+def _digest(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+def _remove(fname: str):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
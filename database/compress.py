@@ -0,0 +1,337 @@
+"""Block-parallel compression of database files with selectable codecs.
+
+Files are split into fixed-size blocks that are compressed independently on a thread pool (the
+codecs release the GIL). Each block is a complete, standard stream of its codec and the streams
+are simply concatenated, so the result is an ordinary .bz2/.gz/.xz/.zst file that bunzip2, gzip,
+xz, zstd and Python's bz2/gzip/lzma modules read as is.
+
+For parallel decompression the streams are found again by their headers, which are the same for
+every block the codec writes here. A header match inside a stream (or a file with one long stream,
+from before block compression) is noticed when its piece doesn't decompress on its own, and that
+part of the file is decompressed in order instead. Each stream carries the codec's own checksum.
+"""
+
+import bz2
+import gzip
+import lzma
+import os
+import re
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Iterator
+
+from database import pool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = 16 * 1024 * 1024
+IO_SIZE = 4 * 1024 * 1024
+# Longest piece handed to a worker when no stream header turns up
+MAX_PIECE = 2 * BLOCK_SIZE
+
+# What the codecs raise for corrupt data
+_CODEC_ERRORS = (OSError, EOFError, lzma.LZMAError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class Codec:
+    """Compression codec by file extension, with the start of its files and of its streams"""
+
+    def __init__(
+        self,
+        name: str,
+        compress: Callable[[bytes, int | None], bytes],
+        stream: Callable[[], object],
+        magic: bytes,
+        header: bytes,
+        header_size: int,
+    ):
+        self.name = name
+        self.compress = compress
+        self.stream = stream
+        # Start of any file of the codec, used to tell which codec a file is
+        self.magic = magic
+        # Start of the streams written here (header_size bytes), used to split files for decompression
+        self.header = re.compile(header)
+        self.header_size = header_size
+
+
+def _zstd_compress(data: bytes, level: int | None) -> bytes:
+    return zstandard.ZstdCompressor(level=3 if level is None else level, write_checksum=True).compress(data)
+
+def _zstd_stream():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = {
+    "bz2": Codec(
+        "bz2",
+        lambda data, level: bz2.compress(data, 9 if level is None else level),
+        bz2.BZ2Decompressor,
+        b"BZh",
+        # Stream header and the first block's magic
+        rb"BZh[1-9]1AY&SY",
+        10,
+    ),
+    "xz": Codec(
+        "xz",
+        lambda data, level: lzma.compress(data, preset=6 if level is None else level),
+        lzma.LZMADecompressor,
+        b"\xfd7zXZ\x00",
+        # Magic, CRC64 check flags and their CRC32
+        re.escape(lzma.compress(b"")[:12]),
+        12,
+    ),
+    "gz": Codec(
+        "gz",
+        lambda data, level: gzip.compress(data, 6 if level is None else level, mtime=0),
+        lambda: zlib.decompressobj(zlib.MAX_WBITS | 16),
+        b"\x1f\x8b",
+        # Magic, deflate, no flags and no modification time
+        rb"\x1f\x8b\x08\x00\x00\x00\x00\x00",
+        8,
+    ),
+    "zst": Codec("zst", _zstd_compress, _zstd_stream, b"\x28\xb5\x2f\xfd", rb"\x28\xb5\x2f\xfd", 4),
+}
+
+
+def available() -> list[str]:
+    """Codecs that can be used here (zst needs the zstandard package)"""
+    return [name for name in CODECS if name != "zst" or zstandard is not None]
+
+def get_codec(name: str) -> Codec:
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}', choose from {list(CODECS)}!")
+    if name not in available():
+        raise RuntimeError(f"Codec '{name}' needs the zstandard package!")
+
+    return CODECS[name]
+
+def compress_file(
+    src: str,
+    dst: str,
+    codec: str = "bz2",
+    level: int | None = None,
+    workers: int | None = None,
+    block_size: int = BLOCK_SIZE,
+) -> dict[str, float]:
+    """Compresses src to dst in parallel blocks, returns sizes, ratio and MB/s"""
+    start = time.perf_counter()
+
+    with open(src, "rb", buffering=IO_SIZE) as f_in, open(dst, "wb", buffering=IO_SIZE) as f_out:
+        raw, written = compress_stream(f_in, f_out, codec, level, workers, block_size)
+
+    return _stats(codec, raw, written, time.perf_counter() - start)
+
+def decompress_file(src: str, dst: str, workers: int | None = None, codec: str | None = None) -> dict[str, float]:
+    """Decompresses src (any file of the codec, default detected from its first bytes) to dst.
+
+    Raises ValueError if the data is corrupt or truncated.
+    """
+    with open(src, "rb", buffering=IO_SIZE) as f_in:
+        return decompress_into(f_in, dst, workers, codec)
+
+def decompress_into(
+    f_in: BinaryIO,
+    dst: str,
+    workers: int | None = None,
+    codec: str | None = None,
+    check: Callable[[], None] | None = None,
+) -> dict[str, float]:
+    """Decompresses f_in (see decompress_file) to a temp file that's renamed to dst once it checks out.
+
+    check is called before the rename for checks of its own (e.g. of the compressed data), and
+    should raise if the data is bad. dst is left untouched if anything fails, otherwise any
+    -wal/-shm files it had are removed with it.
+    """
+    start = time.perf_counter()
+    tmp = dst + ".tmp"
+
+    try:
+        with open(tmp, "wb", buffering=IO_SIZE) as f_out:
+            name, raw = decompress_stream(f_in, f_out, workers, codec)
+
+        if check is not None:
+            check()
+
+        # A database being replaced can't keep its WAL (see pool.remove_side_files)
+        pool.remove_side_files(dst)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return _stats(name, raw, f_in.tell(), time.perf_counter() - start)
+
+def compress_stream(
+    f_in: BinaryIO,
+    f_out: BinaryIO,
+    codec: str = "bz2",
+    level: int | None = None,
+    workers: int | None = None,
+    block_size: int = BLOCK_SIZE,
+) -> tuple[int, int]:
+    """Compresses f_in to f_out a block per stream, returns raw and compressed byte counts"""
+    codec = get_codec(codec)
+    raw = written = 0
+
+    def blocks() -> Iterator[bytes]:
+        nonlocal raw
+        while block := f_in.read(block_size):
+            raw += len(block)
+            yield block
+
+    for _, data in _ordered_map(lambda block: codec.compress(block, level), blocks(), workers):
+        f_out.write(data)
+        written += len(data)
+
+    # An empty file is still a valid file of the codec
+    if not written:
+        data = codec.compress(b"", level)
+        f_out.write(data)
+        written += len(data)
+
+    return raw, written
+
+def decompress_stream(
+    f_in: BinaryIO, f_out: BinaryIO, workers: int | None = None, codec: str | None = None
+) -> tuple[str, int]:
+    """Decompresses f_in to f_out, returns the codec name and raw byte count (see decompress_file)"""
+    head = f_in.read(IO_SIZE)
+
+    detected = next((c.name for c in CODECS.values() if head.startswith(c.magic)), None)
+    if detected is None:
+        raise ValueError(f"Not a file of any of the codecs {list(CODECS)}!")
+    if codec is not None and codec != detected:
+        raise ValueError(f"Expected a {codec} file, got {detected}!")
+    codec = get_codec(detected)
+
+    def decompress(piece: tuple[bytes, bool]) -> bytes | None:
+        """Decompresses a piece that starts a stream, None if it doesn't decompress on its own"""
+        data, starts_stream = piece
+        if not starts_stream:
+            return None
+
+        stream = _Streams(codec)
+        try:
+            block = stream.feed(data)
+        except _CODEC_ERRORS:
+            return None
+
+        return block if stream.at_boundary else None
+
+    raw = 0
+    serial = None
+    for (data, _), result in _ordered_map(decompress, _pieces(head, f_in, codec), workers):
+        # Pieces are decompressed in order from where one didn't decompress on its own, until a
+        # stream ends at the end of a piece
+        if serial is None and result is not None:
+            block = result
+        else:
+            serial = serial or _Streams(codec)
+            try:
+                block = serial.feed(data)
+            except _CODEC_ERRORS as e:
+                raise ValueError(f"Compressed file is corrupt ({e})!") from e
+            if serial.at_boundary:
+                serial = None
+
+        f_out.write(block)
+        raw += len(block)
+
+    if serial is not None:
+        raise ValueError("Compressed file is truncated!")
+
+    return codec.name, raw
+
+def _pieces(head: bytes, f_in: BinaryIO, codec: Codec) -> Iterator[tuple[bytes, bool]]:
+    """Splits the file at its stream headers, yields (piece, whether it starts with a header)"""
+    buffer = bytearray(head)
+    starts_stream = True
+    scan_from = 1
+
+    while True:
+        match = codec.header.search(buffer, scan_from)
+        if match:
+            yield bytes(buffer[:match.start()]), starts_stream
+            del buffer[:match.start()]
+            starts_stream = True
+            scan_from = 1
+            continue
+
+        # No header, cut long pieces anyway (keeping enough to find a header across the cut)
+        if len(buffer) > MAX_PIECE:
+            cut = len(buffer) - codec.header_size + 1
+            yield bytes(buffer[:cut]), starts_stream
+            del buffer[:cut]
+            starts_stream = False
+
+        scan_from = max(1, len(buffer) - codec.header_size + 1)
+        data = f_in.read(IO_SIZE)
+        if not data:
+            break
+        buffer += data
+
+    if buffer:
+        yield bytes(buffer), starts_stream
+
+
+class _Streams:
+    """Incremental decompression of back-to-back streams of a codec"""
+
+    def __init__(self, codec: Codec):
+        self.codec = codec
+        self.decompressor = codec.stream()
+        # Whether everything fed so far ended exactly at the end of a stream
+        self.at_boundary = True
+
+    def feed(self, data: bytes) -> bytes:
+        out = []
+
+        while data:
+            self.at_boundary = False
+            out.append(self.decompressor.decompress(data))
+
+            if not self.decompressor.eof:
+                break
+
+            # Next stream starts in the rest of the data
+            data = self.decompressor.unused_data
+            self.decompressor = self.codec.stream()
+            self.at_boundary = True
+
+        return b"".join(out)
+
+
+def _ordered_map(fn: Callable, items: Iterator, workers: int | None) -> Iterator[tuple]:
+    """Yields (item, fn(item)) in order, with at most 2x workers items in flight"""
+    workers = workers or os.cpu_count() or 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(fn, item)))
+
+            if len(pending) >= 2 * workers:
+                item, future = pending.popleft()
+                yield item, future.result()
+
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+def _stats(codec: str, raw: int, compressed: int, elapsed: float) -> dict[str, float]:
+    elapsed = max(elapsed, 1e-9)
+
+    return {
+        "codec": codec,
+        "raw_bytes": raw,
+        "compressed_bytes": compressed,
+        "ratio": raw / compressed if compressed else 0.0,
+        "seconds": elapsed,
+        "mb_per_s": raw / (1024 ** 2) / elapsed,
+    }
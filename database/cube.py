@@ -0,0 +1,245 @@
+"""Dense (printing x day x finish) price cube kept in a memory-mapped file."""
+
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from database.tables import prices
+
+FINISHES = ["usd", "usd_foil", "usd_etched"]
+
+# Printings the file has room for before it's laid out again with double the room
+CAPACITY = 1 << 17
+
+# Intervals read from sqlite at once while filling
+FETCH_SIZE = 100_000
+
+
+class PriceCube:
+    """float32 prices of every printing on every loaded day, NaN where there was no price.
+
+    Stored day-major in `path`/prices_<capacity>.f32 (days x capacity x finishes) so a new day is
+    appended to the end of the file, with the printing ids in ids.txt and the loaded days in meta.json.
+    meta.json is written last, so an interrupted sync leaves the previous cube readable.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        meta = _load_json(os.path.join(path, "meta.json"))
+        self.capacity = meta.get("capacity", CAPACITY)
+        self.days = np.array(meta.get("days", []), dtype=np.int32)
+
+        # Bytes past the count in meta.json are from an interrupted sync
+        self._ids_bytes = meta.get("ids_bytes", 0)
+        self.ids = []
+        if self._ids_bytes:
+            with open(os.path.join(path, "ids.txt"), "rb") as f:
+                self.ids = f.read(self._ids_bytes).decode().split("\n")[:-1]
+        self.index = {card_id: row for row, card_id in enumerate(self.ids)}
+        self._saved_ids = len(self.ids)
+
+        self._array = None
+        self._map()
+
+    @property
+    def values(self) -> np.ndarray:
+        """(printing, day, finish) view of the cube, rows in the order of ids"""
+        if self._array is None:
+            return np.empty((len(self.ids), 0, len(FINISHES)), dtype=np.float32)
+
+        return self._array[:, :len(self.ids)].transpose(1, 0, 2)
+
+    def day_index(self, utc: str) -> int:
+        """Column of the YYYY-MM-DD date in values"""
+        day = prices.to_day(utc)
+        i = int(np.searchsorted(self.days, day))
+        if i == len(self.days) or self.days[i] != day:
+            raise KeyError(f"{utc} isn't loaded in the price cube!")
+
+        return i
+
+    def dates(self) -> list[str]:
+        """Loaded days as YYYY-MM-DD, in column order"""
+        return [prices.from_day(int(day)).isoformat() for day in self.days]
+
+    def sync(self, conn: sqlite3.Connection, archives: list[str] | None = None, refresh: bool = False) -> int:
+        """Brings the cube up to date with the database, returns the number of days written.
+
+        Days after the last one in the cube are appended, and with refresh the last day is written
+        again too (for after it's been updated). An empty cube is built from the archives (oldest
+        first) and then the database.
+        """
+        # Days archived before the cube caught up can't be appended
+        first, = conn.execute("SELECT MIN(day) FROM PriceDays").fetchone()
+        if len(self.days) and first is not None and first > self.days[-1]:
+            self._reset()
+
+        if not len(self.days):
+            written = 0
+            for fname in archives or []:
+                conn.execute("ATTACH DATABASE ? AS archive", (fname,))
+                try:
+                    written += self._write(conn, "archive", None)
+                finally:
+                    conn.execute("DETACH DATABASE archive")
+
+            return written + self._write(conn, "main", None)
+
+        since = int(self.days[-1]) if refresh else int(self.days[-1]) + 1
+
+        return self._write(conn, "main", since)
+
+    # Writing -------------------------
+
+    def _write(self, conn: sqlite3.Connection, schema: str, since: int | None) -> int:
+        """Writes the schema's loaded days from since on (all if None), returns how many"""
+        c = conn.cursor()
+
+        query = f"SELECT day FROM {schema}.PriceDays"
+        if since is not None:
+            query += f" WHERE day >= {since}"
+        days = [day for day, in c.execute(query + " ORDER BY day")]
+        if not days:
+            c.close()
+            return 0
+
+        first = int(np.searchsorted(self.days, days[0]))
+        self._resize(np.concatenate([self.days[:first], days]).astype(np.int32))
+        self._array[first:] = np.nan
+
+        c.execute(f"""
+            SELECT k.id, h.valid_from, h.valid_to, h.usd, h.usd_foil, h.usd_etched
+            FROM {schema}.PriceHistory h INNER JOIN {schema}.CardKeys k ON k.key = h.key
+            WHERE h.valid_to >= ?
+        """, (days[0],))
+
+        while rows := c.fetchmany(FETCH_SIZE):
+            self._fill(rows, first)
+
+        c.close()
+        self._save()
+
+        return len(days)
+
+    def _fill(self, rows: list[tuple], first: int):
+        """Sets the prices of (id, valid_from, valid_to, *cents) intervals on days from first on"""
+        card_ids, valid_from, valid_to, *cents = zip(*rows)
+
+        # Loaded days each interval covers, as a [start, end) range of columns
+        days = self.days[first:]
+        start = first + np.searchsorted(days, np.array(valid_from), side="left")
+        end = first + np.searchsorted(days, np.array(valid_to), side="right")
+        lengths = np.maximum(end - start, 0)
+
+        rows = self._rows(card_ids)
+        values = np.array(cents, dtype=np.float64).T / 100
+
+        # One (day, row) cell per covered day of every interval
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        cols = np.repeat(start, lengths) + offsets
+
+        self._array[cols, np.repeat(rows, lengths)] = np.repeat(values, lengths, axis=0)
+
+    def _rows(self, card_ids: tuple[str]) -> np.ndarray:
+        """Rows of the given ids, adding rows for new ones"""
+        rows = np.empty(len(card_ids), dtype=np.int64)
+        for i, card_id in enumerate(card_ids):
+            row = self.index.get(card_id)
+            if row is None:
+                row = self.index[card_id] = len(self.ids)
+                self.ids.append(card_id)
+            rows[i] = row
+
+        if len(self.ids) > self.capacity:
+            self._grow(len(self.ids))
+
+        return rows
+
+    # Storage -------------------------
+
+    def _fname(self, capacity: int) -> str:
+        return os.path.join(self.path, f"prices_{capacity}.f32")
+
+    def _map(self):
+        fname = self._fname(self.capacity)
+        if not len(self.days) or not os.path.exists(fname):
+            self._array = None
+            return
+
+        self._array = np.memmap(
+            fname, dtype=np.float32, mode="r+", shape=(len(self.days), self.capacity, len(FINISHES))
+        )
+
+    def _resize(self, days: np.ndarray):
+        """Sets the loaded days, growing/shrinking the file (new days aren't initialized)"""
+        os.makedirs(self.path, exist_ok=True)
+
+        self._array = None
+        self.days = days
+
+        with open(self._fname(self.capacity), "ab") as f:
+            f.truncate(len(days) * self.capacity * len(FINISHES) * 4)
+
+        self._map()
+
+    def _grow(self, n_ids: int):
+        """Copies the cube to a file with room for at least n_ids printings"""
+        capacity = self.capacity
+        while capacity < n_ids:
+            capacity *= 2
+
+        shape = (len(self.days), capacity, len(FINISHES))
+        grown = np.memmap(self._fname(capacity), dtype=np.float32, mode="w+", shape=shape)
+        grown[:, self.capacity:] = np.nan
+        for i in range(len(self.days)):
+            grown[i, :self.capacity] = self._array[i]
+
+        # The old file is removed once meta.json points at the new one (see _save)
+        self._array = grown
+        self.capacity = capacity
+
+    def _reset(self):
+        """Empties the cube so the next sync builds it again"""
+        self._array = None
+        self.days = np.array([], dtype=np.int32)
+        self.ids, self.index = [], {}
+        self._ids_bytes = self._saved_ids = 0
+
+    def _save(self):
+        """Flushes the array and ids, then records them in meta.json"""
+        if self._array is not None:
+            self._array.flush()
+
+        with open(os.path.join(self.path, "ids.txt"), "ab") as f:
+            f.truncate(self._ids_bytes)
+            f.write("".join(card_id + "\n" for card_id in self.ids[self._saved_ids:]).encode())
+            self._ids_bytes = f.tell()
+        self._saved_ids = len(self.ids)
+
+        _save_json(os.path.join(self.path, "meta.json"), {
+            "capacity": self.capacity,
+            "ids_bytes": self._ids_bytes,
+            "days": self.days.tolist(),
+        })
+
+        # Files from before growing
+        for fname in os.listdir(self.path):
+            if fname.endswith(".f32") and os.path.join(self.path, fname) != self._fname(self.capacity):
+                os.remove(os.path.join(self.path, fname))
+
+
+def _load_json(fname: str) -> dict:
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _save_json(fname: str, data: dict):
+    tmp = fname + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, fname)
@@ -1,35 +1,83 @@
 """Wrapper around sqlite3 Connection with utilities for updating and easy querying."""
 
 import os
+import re
 import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Sequence
 
 import pandas as pd
 
-from database.tables import cards, images, prices
+from database.cache import QueryCache, database_version
+from database import movers as movers_scan
+from database.cube import PriceCube
+from database.pool import ConnectionPool
+from database.tables import cards, changes, extract, images, prices, summary
+
+# Rows per DataFrame yielded by the iter_* methods
+CHUNK_SIZE = 10_000
 
 
 class ETGDatabase:
     """Wrapper around sqlite db connection with updating/querying utilities"""
 
     all_table_names = ("Cards", "Images", "Prices")
+    table_modules = {"Cards": cards, "Images": images, "Prices": prices}
+
+    # Page cache used while bulk loading (negative is KiB, so 256 MiB)
+    bulk_cache_size = -256 * 1024
 
-    def __init__(self, database: str | None = None):
+    def __init__(
+        self,
+        database: str | None = None,
+        archive_path: str | None = None,
+        cache: QueryCache | None = None,
+        readers: int = 0,
+    ):
         # If no database given, use most recent db version in data folder
         if database is None:
             path = "data/db/"
 
-            fnames = [fname for fname in os.listdir(path) if ".db" in fname]
+            # Only the databases themselves, not their -wal/-shm files (see ConnectionPool)
+            fnames = [fname for fname in os.listdir(path) if re.fullmatch(r"etg_v\d+\.db", fname)]
             if not fnames:
                 raise FileNotFoundError(f"No databases found in '{path}'!")
 
-            database = max(fnames, key=lambda x: x.split("_")[1][1:])
+            database = max(fnames, key=lambda x: int(re.split("[_.]", x)[1][1:]))
             database = path + database
 
-        self.conn = sqlite3.connect(database)
+        # Monthly price archives are shared by all versions in the database's folder
+        if archive_path is None:
+            archive_path = os.path.join(os.path.dirname(database), "archive")
+        self.archive_path = archive_path
+
+        # Each version keeps its own price cube next to it (see price_cube)
+        stem = os.path.splitext(os.path.basename(database))[0]
+        self.cube_path = os.path.join(os.path.dirname(database), "cube", stem)
+
+        # Optional result cache for query/get_tables/date_range (not the iter_* methods)
+        self.database = database
+        self.cache = cache
+
+        # With readers, reads check out pooled read-only connections so the database can be
+        # shared across threads, and conn is the pool's single writer
+        self.pool = None
+        self._local = threading.local()
+        if readers:
+            self.pool = ConnectionPool(database, readers)
+            self.conn = self.pool.writer
+        else:
+            self.conn = sqlite3.connect(database)
 
     def __del__(self):
         try:
-            self.conn.close()
+            if self.pool is not None:
+                self.pool.close()
+            else:
+                self.conn.close()
         except AttributeError:
             pass
 
@@ -37,10 +85,40 @@ class ETGDatabase:
 
     def info(self, head_size=3):
         """Displays an overview of each table in the database"""
-        cursor = self.conn.cursor()
+        with self._reader() as conn:
+            self._print_info(conn.cursor(), head_size)
+
+    def latest_date(self) -> str | None:
+        """Returns the latest date prices were loaded for (YYYY-MM-DD), None if there are none"""
+        try:
+            with self._reader() as conn:
+                day = conn.execute("SELECT MAX(day) FROM PriceDays").fetchone()[0]
+        except sqlite3.OperationalError:
+            return None
+
+        return None if day is None else prices.from_day(day).isoformat()
 
+    @contextmanager
+    def reader(self):
+        """Pins one reader to this thread for the with block, so all reads in it share (and yield) it"""
+        if getattr(self._local, "conn", None) is not None:
+            yield self._local.conn
+            return
+
+        with self._reader() as conn:
+            self._local.conn = conn
+            try:
+                yield conn
+            finally:
+                self._local.conn = None
+
+    def pool_stats(self) -> dict[str, int | float] | None:
+        """Reader pool wait times and utilization (see ConnectionPool.stats), None if not pooled"""
+        return None if self.pool is None else self.pool.stats()
+
+    def _print_info(self, cursor: sqlite3.Cursor, head_size: int):
         for table in self.all_table_names:
-            cursor.execute(f"SELECT * FROM {table} LIMIT {head_size}")
+            cursor.execute(f"SELECT * FROM {table} LIMIT ?", (head_size,))
 
             print(f"=== {table} ===")
 
@@ -56,56 +134,514 @@ class ETGDatabase:
 
     # Querying ------------------------
 
-    def query(self, query) -> pd.DataFrame:
-        """Shorthand for SQL query."""
-        return pd.read_sql(query, self.conn)
-
-    def get_table(self, table_name: str) -> pd.DataFrame:
-        """Returns the full table of the given name as a DataFrame."""
-        return self.get_tables([table_name])
+    def query(self, query: str, params: Sequence | dict | None = None) -> pd.DataFrame:
+        """Shorthand for SQL query, use ? or :name placeholders with params for values."""
+        return self._read(query, params)
 
-    def get_tables(self, table_names: list[str]) -> pd.DataFrame:
-        """Inner joins all tables in given list and returns as DataFrame."""
-        table_names = [name.title() for name in table_names if name in self.all_table_names]
+    def get_table(self, table_name: str, columns: list[str] | None = None, **filters) -> pd.DataFrame:
+        """Returns the full table of the given name as a DataFrame (see get_tables for columns/filters)."""
+        return self.get_tables([table_name], columns, **filters)
 
-        query = f"SELECT * FROM {table_names[0]}"
-        for name in table_names[1:]:
-            query += f" INNER JOIN {name} USING(id)"
+    def get_tables(
+        self,
+        table_names: list[str],
+        columns: list[str] | None = None,
+        start: str | None = None,
+        end: str | None = None,
+        **filters,
+    ) -> pd.DataFrame:
+        """Inner joins all tables in given list and returns as DataFrame.
 
-        return pd.read_sql(query, self.conn)
+        Only the given columns are selected (all by default). Keyword filters match a column
+        against a value or any of a list of values, e.g. name="Sol Ring" or id=[...], and
+        start/end (YYYY-MM-DD, inclusive) limit Prices days. Filters are compiled into the SQL,
+        so only matching rows are read. Archived months are only read by date_range.
+        """
+        query, params = self._tables_query(table_names, columns, filters, start, end)
+        return self._read(query, params)
 
     def get_all(self) -> pd.DataFrame:
         """Inner joins and returns all tables (expensive and likely unnecessary, see get_tables)."""
         return self.get_tables(self.all_table_names)
     
-    def date_range(self, start: str, end: str | None = None) -> pd.DataFrame:
+    def date_range(
+        self, start: str, end: str | None = None, columns: list[str] | None = None, **filters
+    ) -> pd.DataFrame:
         """Returns Card/Price date between given range (inclusive).
         
         Format date strings as YYYY-MM-DD. If no end date given, defaults to today.
+        Months that have been archived (see prices.archive) are read from their archive files.
+        Columns and filters work like get_tables.
+        """
+        dfs = []
+        for fname, query, params in self._date_range_queries(start, end, columns, filters):
+            dfs.append(self._read(query, params, fname))
+
+        return pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
+
+    def search_cards(self, text: str, limit: int = 20) -> pd.DataFrame:
+        """Card names matching text anywhere in the name or set name, best matches first.
+
+        Returns name and number of printings, names starting with text ranked first. Uses the
+        CardSearch trigram index (see cards.create_search), text shorter than 3 characters (or
+        databases not updated since the index was added) only match name prefixes.
+        """
+        text = text.strip()
+        if not text:
+            return pd.DataFrame({"name": [], "printings": []})
+
+        prefix = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+        with self._reader() as conn:
+            indexed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'CardSearch'").fetchone()
+
+        # Trigrams need at least 3 characters
+        if len(text) < 3 or not indexed:
+            query = """
+                SELECT name, COUNT(*) AS printings FROM Cards
+                WHERE name LIKE ? ESCAPE '\\'
+                GROUP BY name ORDER BY name LIMIT ?
+            """
+            return self.query(query, [prefix, limit])
+
+        # Name matches weigh more than set name matches
+        # (bm25 can't be used once the CTE is flattened into the grouping)
+        query = """
+            WITH hits AS MATERIALIZED (
+                SELECT c.name AS name, bm25(CardSearch, 10.0, 1.0) AS score
+                FROM CardSearch INNER JOIN Cards c ON c.rowid = CardSearch.rowid
+                WHERE CardSearch MATCH ?
+            )
+            SELECT name, COUNT(*) AS printings FROM hits
+            GROUP BY name ORDER BY MAX(name LIKE ? ESCAPE '\\') DESC, MIN(score), name LIMIT ?
+        """
+        phrase = '"' + text.replace('"', '""') + '"'
+
+        return self.query(query, [phrase, prefix, limit])
+
+    def latest_prices(self, ids: list[str] | None = None) -> pd.DataFrame:
+        """Every card's most recent prices with the date they're from (see summary.update)"""
+        finishes = ", ".join(f"{f} / 100.0 AS {f}" for f in summary.FINISHES)
+        query = f"SELECT id, date(day * 86400, 'unixepoch') AS utc, {finishes} FROM LatestPrices"
+
+        return self._read(*self._summary_query(query, ids))
+
+    def price_deltas(self, ids: list[str] | None = None) -> pd.DataFrame:
+        """Change in each finish of the cards listed on the latest day since the previous loaded day.
+
+        Has the current and previous prices, the change and the percent change (None without both).
+        """
+        finishes = ", ".join(
+            f"{f} / 100.0 AS {f}, prev_{f} / 100.0 AS prev_{f}, ({f} - prev_{f}) / 100.0 AS {f}_change, "
+            f"100.0 * ({f} - prev_{f}) / NULLIF(prev_{f}, 0) AS {f}_pct"
+            for f in summary.FINISHES
+        )
+        query = f"""
+            SELECT id, date(day * 86400, 'unixepoch') AS utc, date(prev_day * 86400, 'unixepoch') AS prev_utc,
+            {finishes} FROM PriceDeltas
         """
-        if end is None:
-            end = self._current_date()
 
-        return pd.read_sql(f"""
-           SELECT * FROM Cards INNER JOIN Prices USING(id)
-           WHERE utc BETWEEN '{start}' AND '{end}'
-        """, self.conn)
+        return self._read(*self._summary_query(query, ids))
+
+    def rolling_stats(self, days: int = 7, ids: list[str] | None = None) -> pd.DataFrame:
+        """Average price per finish over the last days (one of summary.WINDOWS) and how many it covers"""
+        if days not in summary.WINDOWS:
+            raise ValueError(f"Rolling stats are only kept over {summary.WINDOWS} days!")
+
+        finishes = ", ".join(f"{f}_sum / 100.0 / NULLIF({f}_n, 0) AS {f}_avg, {f}_n" for f in summary.FINISHES)
+        query = f"SELECT id, {finishes} FROM RollingStats WHERE days = {int(days)}"
+
+        return self._read(*self._summary_query(query, ids))
+
+    def changes_since(self, seq: int = 0, limit: int | None = None) -> pd.DataFrame:
+        """Changes logged by updates after seq, in order (see changes.begin).
+
+        Has seq, utc, source (Cards, Images or Prices), op (insert, update or delete), id and the
+        new prices for Prices changes. Keep the last seq seen and pass it next time to only get
+        what changed since. Changes are kept for changes.RETENTION_DAYS days.
+        """
+        finishes = ", ".join(f"l.{f} / 100.0 AS {f}" for f in changes.FINISHES)
+        query = f"""
+            SELECT l.seq, date(l.day * 86400, 'unixepoch') AS utc, l.source, l.op, k.id, {finishes}
+            FROM ChangeLog l INNER JOIN CardKeys k ON k.key = l.key
+            WHERE l.seq > ? ORDER BY l.seq
+        """
+        params = [seq]
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+
+        return self._read(query, params)
+
+    def change_seq(self) -> int:
+        """Latest logged change's seq (0 if none), to start tailing changes_since from now"""
+        try:
+            with self._reader() as conn:
+                seq = conn.execute("SELECT MAX(seq) FROM ChangeLog").fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+
+        return seq or 0
+
+    def price_cube(self) -> PriceCube:
+        """Returns the (printing x day x finish) price cube, built/caught up with the database first.
+
+        PriceCube.values is a memory-mapped float32 view with rows in PriceCube.ids order, one column
+        per loaded day and usd/usd_foil/usd_etched as the last axis (NaN where there was no price).
+        Once built, update() appends each new day to it.
+        """
+        # Syncing writes the cube's files, so it's serialized with updates
+        with self._writer():
+            cube = PriceCube(self.cube_path)
+            written = cube.sync(self.conn, prices.archive_files(self.archive_path, "0000-01-01", "9999-12-31"))
+        if written > 1:
+            print(f"db: Wrote {written} days to price cube.")
+
+        return cube
+
+    def movers(self, date: str | None = None, limit: int | None = None, **kwargs) -> pd.DataFrame:
+        """Ranked price movers of every printing/finish on date (default latest) with card names.
+
+        See movers.scan for the columns and options (window, min_price, min_history, rank_by).
+        """
+        df = movers_scan.scan(self.price_cube(), date, **kwargs)
+        if limit is not None:
+            df = df.head(limit)
+
+        names = self.get_table("Cards", ["id", "name", "set_name"], id=list(df["id"].unique()))
+        df = df.merge(names, on="id", how="left")
+
+        # Names after the date/id
+        return df[["utc", "id", "name", "set_name", *df.columns[2:-2]]]
+
+    # Streaming -----------------------
+
+    def iter_query(
+        self, query: str, params: Sequence | dict | None = None, chunk_size: int = CHUNK_SIZE
+    ) -> Iterator[pd.DataFrame]:
+        """Like query, but yields DataFrames of at most chunk_size rows fetched from the cursor."""
+        yield from self._iter_read(query, params, chunk_size)
+
+    def iter_tables(
+        self,
+        table_names: list[str],
+        columns: list[str] | None = None,
+        start: str | None = None,
+        end: str | None = None,
+        chunk_size: int = CHUNK_SIZE,
+        **filters,
+    ) -> Iterator[pd.DataFrame]:
+        """Like get_tables, but yields DataFrames of at most chunk_size rows."""
+        query, params = self._tables_query(table_names, columns, filters, start, end)
+        yield from self.iter_query(query, params, chunk_size)
+
+    def iter_all(self, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+        """Like get_all, but yields DataFrames of at most chunk_size rows."""
+        yield from self.iter_tables(self.all_table_names, chunk_size=chunk_size)
+
+    def iter_date_range(
+        self,
+        start: str,
+        end: str | None = None,
+        columns: list[str] | None = None,
+        chunk_size: int = CHUNK_SIZE,
+        **filters,
+    ) -> Iterator[pd.DataFrame]:
+        """Like date_range, but yields DataFrames of at most chunk_size rows."""
+        for fname, query, params in self._date_range_queries(start, end, columns, filters):
+            yield from self._iter_read(query, params, chunk_size, fname)
 
     # Modification --------------------
 
-    def update(self, df: pd.DataFrame, date: str | None = None):
-        """Given an API response as a dictionary, creates/updates all tables"""
+    def update(self, data: pd.DataFrame | Iterable[dict], date: str | None = None):
+        """Given an API response (records or a DataFrame of them), creates/updates all tables"""
+        if isinstance(data, pd.DataFrame):
+            data = data.to_dict("records")
+
+        self.update_records(data, date)
+
+    def update_records(self, records: Iterable[dict], date: str | None = None):
+        """Creates/updates all tables from a stream of records (see scry.read_bulk_file).
+
+        Records are extracted in batches and all written in a single transaction under the same date.
+        """
         if date is None:
             date = self._current_date()
-        df["utc"] = date
 
-        # Update tables
-        cards.update(df, self.conn)
-        images.update(df, self.conn)
-        prices.update(df, self.conn)
+        self.update_extracted(extract.iter_extract(records, date), date)
+
+    def update_extracted(self, batches: Iterable[dict[str, dict[str, list]]], date: str):
+        """Creates/updates all tables from batches of extracted columns (see extract.extract).
+
+        All batches are written in a single transaction and must be for the given date.
+        """
+        # The pool's writer is held throughout, so syncs and other updates wait their turn
+        with self._writer():
+            n_rows = 0
+            stats = {name: Counter() for name in self.all_table_names}
+            start = time.perf_counter()
+
+            with self._bulk_load():
+                try:
+                    # Log what this day's load writes (see changes_since)
+                    changes.begin(self.conn, date)
+
+                    for columns in batches:
+                        for name, counts in self.update_columns(columns).items():
+                            stats[name].update(counts)
+                        n_rows += len(columns["Prices"]["id"])
+
+                    # Close the price history of cards no longer listed
+                    stats["Prices"]["written"] += prices.finish(self.conn, date)
+
+                    # Name search index (only does anything the first time)
+                    cards.create_search(self.conn.cursor())
+
+                    # Latest prices, deltas and rolling stats from just this day
+                    summary.update(self.conn, date)
+                    changes.end(self.conn)
+                    changes.trim(self.conn, date)
+                except BaseException:
+                    self.conn.rollback()
+                    raise
+
+                # Commit transaction
+                self.conn.commit()
+
+            # Roll months past retention into their archive files
+            prices.archive(self.conn, self.archive_path)
+
+            # Append the day to the price cube if one has been built
+            if os.path.exists(os.path.join(self.cube_path, "meta.json")):
+                PriceCube(self.cube_path).sync(self.conn, refresh=True)
+
+            # Cached results are keyed on the file version anyway, this frees their space
+            if self.cache is not None:
+                self.cache.invalidate(self.database)
+
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            for name in ("Cards", "Images"):
+                counts = stats[name]
+                print(f"db: {name}: {counts['inserted']} inserted, {counts['changed']} changed, "
+                      f"{counts['unchanged']} unchanged")
+            print(f"db: Loaded {n_rows} price rows ({stats['Prices']['written']} written) "
+                  f"in {elapsed:.2f}s [{n_rows / elapsed:.0f} rows/s]")
+
+    def update_columns(self, columns: dict[str, dict[str, list]]) -> dict[str, dict[str, int]]:
+        """Updates all tables from extracted column arrays (see extract.extract) without committing.
+
+        Returns the row counts reported by each table's update.
+        """
+        return {
+            "Cards": cards.update(columns["Cards"], self.conn),
+            "Images": images.update(columns["Images"], self.conn),
+            "Prices": {"written": prices.update(columns["Prices"], self.conn)},
+        }
+
+    @contextmanager
+    def _bulk_load(self):
+        """Tunes the connection for one large write transaction, restoring settings afterwards.
+
+        Only settings local to the connection are changed. The journal mode belongs to the file
+        (see ConnectionPool), and changing it needs every other connection to be closed.
+        """
+        c = self.conn.cursor()
+
+        settings = {
+            pragma: c.execute(f"PRAGMA {pragma}").fetchone()[0]
+            for pragma in ("synchronous", "cache_size", "temp_store")
+        }
+
+        c.execute("PRAGMA synchronous = OFF")
+        c.execute(f"PRAGMA cache_size = {self.bulk_cache_size}")
+        c.execute("PRAGMA temp_store = MEMORY")
+
+        try:
+            yield
+        finally:
+            for pragma, value in settings.items():
+                c.execute(f"PRAGMA {pragma} = {value}")
+            c.close()
+
+    @staticmethod
+    def _summary_query(query: str, ids: list[str] | None) -> tuple[str, list]:
+        """Adds an id filter to a summary table query"""
+        if ids is None:
+            return query, []
+
+        where = " AND " if " WHERE " in query else " WHERE "
+        return query + f"{where}id IN ({', '.join('?' * len(ids))})", list(ids)
+
+    def _tables_query(
+        self,
+        table_names: list[str],
+        columns: list[str] | None = None,
+        filters: dict | None = None,
+        start: str | None = None,
+        end: str | None = None,
+        prices_schema: str = "main",
+    ) -> tuple[str, list]:
+        """(SQL, params) inner joining the given tables with projection and filters pushed down
+
+        Table and column names are checked against the table modules, values are bound as params.
+        """
+        table_names = [name.title() for name in table_names if name.title() in self.all_table_names]
+        if not table_names:
+            raise ValueError("No known tables given!")
+
+        available = self._select_list(table_names)
+        if "Prices" in table_names:
+            available.append("day")
+
+        if columns is None:
+            columns = self._select_list(table_names)
+        for column in [*columns, *(filters or {})]:
+            if column not in available:
+                raise ValueError(f"Unknown column '{column}' for tables {table_names}!")
+
+        if (start is not None or end is not None) and "Prices" not in table_names:
+            raise ValueError("Date filters need the Prices table!")
+
+        # Date ranges read the price tables directly, bounding both the days and the intervals
+        # (see prices.between), otherwise Prices is the view of the given schema
+        params = []
+        prices_source = "Prices" if prices_schema == "main" else f"{prices_schema}.Prices"
+        if start is not None or end is not None:
+            subquery, params = prices.between(
+                prices_schema,
+                None if start is None else prices.to_day(start),
+                None if end is None else prices.to_day(end),
+            )
+            prices_source = f"({subquery}) AS Prices"
+
+        sources = [prices_source if name == "Prices" else name for name in table_names]
+        query = f"SELECT {', '.join(columns)} FROM {sources[0]}"
+        for source in sources[1:]:
+            query += f" INNER JOIN {source} USING(id)"
+
+        # Single values compare with =, lists with IN so either can use the indexes
+        where = []
+        for column, value in (filters or {}).items():
+            if isinstance(value, (list, tuple, set)):
+                value = list(value)
+                where.append(f"{column} IN ({', '.join('?' * len(value))})")
+                params += value
+            else:
+                where.append(f"{column} = ?")
+                params.append(value)
+
+        if where:
+            query += " WHERE " + " AND ".join(where)
+
+        return query, params
+
+    def _date_range_queries(
+        self, start: str, end: str | None, columns: list[str] | None = None, filters: dict | None = None
+    ) -> list[tuple[str | None, str, list]]:
+        """(archive file or None for this database, SQL, params) covering the date range"""
+        if end is None:
+            end = self._current_date()
+
+        # Only archives of months overlapping the range are attached
+        queries = []
+        for fname in prices.archive_files(self.archive_path, start, end):
+            query, params = self._tables_query(
+                ["Cards", "Prices"], columns, filters, start, end, prices_schema="archive"
+            )
+            queries.append((fname, query, params))
+
+        query, params = self._tables_query(["Cards", "Prices"], columns, filters, start, end)
+        queries.append((None, query, params))
+
+        return queries
+
+    def _read(self, query: str, params: Sequence | dict | None = None, archive: str | None = None) -> pd.DataFrame:
+        """Runs query (with archive attached if given) through the result cache if there is one"""
+        def load():
+            with self._reader() as conn, self._attached(conn, archive):
+                return pd.read_sql(query, conn, params=params)
+
+        if self.cache is None:
+            return load()
+
+        # Results read from an archive also depend on that file's version
+        key_params = params if archive is None else [params, archive, database_version(archive)]
+
+        return self.cache.get(self.database, query, key_params, load)
+
+    def _iter_read(
+        self, query: str, params: Sequence | dict | None, chunk_size: int, archive: str | None = None
+    ) -> Iterator[pd.DataFrame]:
+        """Yields chunks of query (with archive attached if given), holding one reader throughout"""
+        with self._iter_reader() as conn, self._attached(conn, archive):
+            yield from pd.read_sql(query, conn, params=params, chunksize=chunk_size)
+
+    @contextmanager
+    def _reader(self):
+        """Checks out a pooled reader (unless one is pinned, see reader), or uses conn if not pooled"""
+        pinned = getattr(self._local, "conn", None)
+        if pinned is not None:
+            yield pinned
+            return
+
+        if self.pool is None:
+            yield self.conn
+            return
+
+        with self.pool.reader() as conn:
+            yield conn
+
+    @contextmanager
+    def _iter_reader(self):
+        """Like _reader, but never shares a connection: a pooled reader that isn't pinned, or a
+        connection of its own if not pooled or this thread has one pinned (see reader).
+
+        Iterators keep their reader between chunks, and other reads on the same connection meanwhile
+        would fail on archives (see _attached) that stay locked until the iterator finishes. The
+        pinned reader may be the pool's last free one, so that case doesn't wait on the pool.
+        """
+        if self.pool is not None and getattr(self._local, "conn", None) is None:
+            with self.pool.reader() as conn:
+                yield conn
+            return
+
+        conn = sqlite3.connect(self.database)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _writer(self):
+        """Holds the pool's writer, does nothing if not pooled"""
+        if self.pool is None:
+            yield
+            return
+
+        with self.pool.write():
+            yield
+
+    @staticmethod
+    @contextmanager
+    def _attached(conn: sqlite3.Connection, fname: str | None):
+        """Attaches fname as the archive schema of conn for the duration, does nothing for None"""
+        if fname is None:
+            yield
+            return
+
+        conn.execute("ATTACH DATABASE ? AS archive", (fname,))
+        try:
+            yield
+        finally:
+            conn.execute("DETACH DATABASE archive")
+
+    def _select_list(self, table_names: list[str]) -> list[str]:
+        """Columns of the given tables joined USING(id), leaving out bookkeeping like row_hash"""
+        features = ["id"]
+        for name in table_names:
+            features += [feat for feat in self.table_modules[name].FEATURES if feat != "id"]
 
-        # Commit transaction
-        self.conn.commit()
+        return features
 
     @staticmethod
     def _current_date():
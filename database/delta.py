@@ -0,0 +1,140 @@
+"""Page-level patches between database versions.
+
+A patch holds the pages of the new version that differ from the base version, so a version can be
+pushed/pulled as a patch when the other side already has the one before it:
+
+    header:  MAGIC, format version (1 byte), page size (4 bytes), new file size (8 bytes),
+             sha256 of the base file (32 bytes), sha256 of the new file (32 bytes)
+    pages:   page number (4 bytes), page
+    trailer: page number END
+
+Patches are compressed with database.compress, and applying one checks both checksums.
+"""
+
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+
+from database import compress, pool
+
+MAGIC = b"ETGP"
+VERSION = 1
+# Used when the file isn't a SQLite database
+PAGE_SIZE = 4096
+END = 0xFFFFFFFF
+
+_HEADER = struct.Struct(">4sBIQ32s32s")
+_PAGE = struct.Struct(">I")
+
+
+def diff(base: str, new: str, dst: str, codec: str = "bz2", workers: int | None = None) -> dict[str, int]:
+    """Writes the (compressed) patch from base to new to dst, returns page counts and sizes"""
+    page_size = page_size_of(new)
+    base_sha, new_sha = hashlib.sha256(), hashlib.sha256()
+    pages = changed = 0
+
+    with _temp_file(dst) as raw:
+        raw.write(b"\0" * _HEADER.size)
+
+        with open(base, "rb", buffering=compress.IO_SIZE) as f_base, open(new, "rb", buffering=compress.IO_SIZE) as f_new:
+            while page := f_new.read(page_size):
+                old = f_base.read(page_size)
+                base_sha.update(old)
+                new_sha.update(page)
+
+                if page != old:
+                    raw.write(_PAGE.pack(pages))
+                    raw.write(page)
+                    changed += 1
+                pages += 1
+
+            # Rest of a base that's longer than new
+            while old := f_base.read(compress.IO_SIZE):
+                base_sha.update(old)
+
+            new_size = f_new.tell()
+
+        raw.write(_PAGE.pack(END))
+        raw.seek(0)
+        raw.write(_HEADER.pack(MAGIC, VERSION, page_size, new_size, base_sha.digest(), new_sha.digest()))
+        raw.seek(0)
+
+        with open(dst, "wb", buffering=compress.IO_SIZE) as f_out:
+            _, written = compress.compress_stream(raw, f_out, codec, workers=workers)
+
+    return {"pages": pages, "changed": changed, "new_bytes": new_size, "patch_bytes": written}
+
+def apply(base: str, patch: str, dst: str, workers: int | None = None) -> dict[str, int]:
+    """Rebuilds the new version at dst from base and the patch, returns page counts.
+
+    Raises ValueError if base isn't the patch's base or the result doesn't match the new version,
+    in which case dst is left untouched (otherwise any -wal/-shm files it had are removed with it).
+    """
+    with _temp_file(dst) as raw:
+        with open(patch, "rb", buffering=compress.IO_SIZE) as f_in:
+            compress.decompress_stream(f_in, raw, workers)
+        raw.seek(0)
+
+        head = raw.read(_HEADER.size)
+        if len(head) < _HEADER.size or head[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{patch}' isn't a database patch!")
+
+        _, version, page_size, new_size, base_sha, new_sha = _HEADER.unpack(head)
+        if version != VERSION:
+            raise ValueError(f"Unsupported patch format version {version}!")
+
+        if _sha256(base) != base_sha:
+            raise ValueError(f"'{base}' isn't the version '{patch}' was made from!")
+
+        # Patched next to dst and moved into place once it checks out
+        tmp = dst + ".tmp"
+        shutil.copyfile(base, tmp)
+        changed = 0
+
+        try:
+            with open(tmp, "r+b") as f_out:
+                f_out.truncate(new_size)
+
+                while (page_no := _PAGE.unpack(raw.read(_PAGE.size))[0]) != END:
+                    f_out.seek(page_no * page_size)
+                    f_out.write(raw.read(min(page_size, new_size - page_no * page_size)))
+                    changed += 1
+
+            if _sha256(tmp) != new_sha:
+                raise ValueError(f"Patched database doesn't match the checksum in '{patch}'!")
+
+            # A database being replaced can't keep its WAL (see pool.remove_side_files)
+            pool.remove_side_files(dst)
+            os.replace(tmp, dst)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    return {"pages": -(-new_size // page_size), "changed": changed, "new_bytes": new_size}
+
+def page_size_of(fname: str) -> int:
+    """Page size from the SQLite header (PAGE_SIZE if fname isn't a SQLite database)"""
+    with open(fname, "rb") as f:
+        head = f.read(18)
+
+    if len(head) < 18 or not head.startswith(b"SQLite format 3\0"):
+        return PAGE_SIZE
+
+    # 1 stands for 65536, which doesn't fit in the two bytes
+    page_size = struct.unpack(">H", head[16:18])[0]
+    return 65536 if page_size == 1 else page_size
+
+def _sha256(fname: str) -> bytes:
+    sha = hashlib.sha256()
+
+    with open(fname, "rb") as f:
+        while data := f.read(compress.IO_SIZE):
+            sha.update(data)
+
+    return sha.digest()
+
+def _temp_file(near: str):
+    """Uncompressed patch scratch file, next to near so it's on the same disk"""
+    return tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(near)))
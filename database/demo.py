@@ -36,5 +36,12 @@ def main():
 
     print("\n****************************************\n")
 
+    # Columns and filters are done in SQL, so only matching rows are read
+    print("<< db.get_tables (columns/filters) >>")
+    df = db.get_tables(["Cards", "Prices"], columns=["id", "set_name", "utc", "usd"], name="Sol Ring")
+    print(df.head())
+
+    print("\n****************************************\n")
+
 if __name__ == "__main__":
     main()
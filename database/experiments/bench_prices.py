@@ -0,0 +1,98 @@
+"""Compares size and scan speed of the old and interval Prices layouts on synthetic data."""
+
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from database.tables import prices
+
+N_CARDS = 100_000
+N_DAYS = 30
+# Fraction of prices that change from one day to the next
+CHANGE_RATE = 0.05
+
+
+def make_days(rng: random.Random):
+    """Yields (utc, columns) for each day, ending today so retention keeps them all"""
+    today = datetime.date.today()
+    ids = [str(uuid.UUID(int=i + 1)) for i in range(N_CARDS)]
+    usd = [round(rng.random() * 20, 2) for _ in range(N_CARDS)]
+
+    for day in range(N_DAYS):
+        utc = (today - datetime.timedelta(days=N_DAYS - 1 - day)).isoformat()
+        usd = [round(rng.random() * 20, 2) if rng.random() < CHANGE_RATE else p for p in usd]
+        yield utc, {
+            "id": ids,
+            "utc": [utc] * N_CARDS,
+            "usd": usd,
+            "usd_foil": [p * 2 if i % 3 == 0 else None for i, p in enumerate(usd)],
+            "usd_etched": [None] * N_CARDS,
+        }
+
+def build_old(fpath: str, rng: random.Random) -> str:
+    conn = sqlite3.connect(fpath)
+    conn.execute("""
+        CREATE TABLE Prices (
+            id TEXT, utc TEXT, usd REAL, usd_foil REAL, usd_etched REAL, PRIMARY KEY(id, utc)
+        )
+    """)
+    conn.execute("CREATE INDEX idx_Prices_utc ON Prices(utc)")
+    for utc, data in make_days(rng):
+        conn.executemany("INSERT INTO Prices VALUES (?, ?, ?, ?, ?)", zip(*data.values()))
+    conn.commit()
+    conn.close()
+
+    return "utc BETWEEN '{}' AND '{}'"
+
+def build_history(fpath: str, rng: random.Random) -> str:
+    conn = sqlite3.connect(fpath)
+    for utc, data in make_days(rng):
+        prices.update(data, conn)
+        prices.finish(conn, utc)
+        conn.commit()
+    conn.close()
+
+    return "day BETWEEN {} AND {}"
+
+def timed(conn: sqlite3.Connection, query: str) -> float:
+    start = time.perf_counter()
+    conn.execute(query).fetchall()
+    return time.perf_counter() - start
+
+def main():
+    today = datetime.date.today()
+    week = [today - datetime.timedelta(days=6), today]
+
+    with tempfile.TemporaryDirectory() as path:
+        print(f"Rows: {N_CARDS * N_DAYS} ({N_CARDS} cards x {N_DAYS} days, "
+              f"{CHANGE_RATE:.0%} of prices change daily)")
+
+        for name, build in [("old", build_old), ("history", build_history)]:
+            fpath = os.path.join(path, f"{name}.db")
+            week_filter = build(fpath, random.Random(0))
+            if name == "old":
+                week_filter = week_filter.format(*(day.isoformat() for day in week))
+            else:
+                week_filter = week_filter.format(*(prices.to_day(day.isoformat()) for day in week))
+
+            conn = sqlite3.connect(fpath)
+            size = os.path.getsize(fpath) / 1024 ** 2
+
+            # In SQLite (aggregate) and into Python (fetch) through the Prices table/view
+            results = {
+                "full agg": timed(conn, "SELECT SUM(usd), COUNT(usd_foil) FROM Prices"),
+                "full fetch": timed(conn, "SELECT * FROM Prices"),
+                "week agg": timed(conn, f"SELECT SUM(usd), COUNT(usd_foil) FROM Prices WHERE {week_filter}"),
+                "week fetch": timed(conn, f"SELECT * FROM Prices WHERE {week_filter}"),
+            }
+
+            timings = " | ".join(f"{k} {v:.3f}s" for k, v in results.items())
+            print(f"{name:>8}: {size:6.1f} Mb | {timings}")
+            conn.close()
+
+if __name__ == "__main__":
+    main()
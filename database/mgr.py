@@ -4,16 +4,23 @@ import argparse
 import textwrap
 import os
 import re
-import bz2
 import logging
 import sys
 from functools import total_ordering
 
-# import pandas as pd
+import pandas as pd
 
+from database import backfill, compress, delta, pipeline, pool
+from database.cache import QueryCache
 from database.db import ETGDatabase
 from database.online import scry
-from database.online.gcs import GCSConnection
+from database.online import storage as remote
+
+# Versions pushed as patches in a row before a full copy is pushed again (also how many are kept online)
+DELTA_CHAIN = 3
+PATCH_FILENAME = re.compile(r"etg_v(\d+)_from_v(\d+)\.patch")
+# Monthly price archives (see prices.archive), kept online under archive/
+ARCHIVE_FILENAME = re.compile(r"prices_\d{4}-\d{2}\.db")
 
 
 @total_ordering
@@ -44,23 +51,37 @@ class DBManager:
 
     def update(self):
         """Downloads data and creates/updates database."""
-        path = "data/db/"
+        # Download, parse and write at the same time
+        if self.args.pipeline:
+            db = self._open_working_db()
+            if not pipeline.update(db, force=self.args.force):
+                print("db-mgr: Default cards already ingested, nothing to update (use --force to override).")
+            return
+
+        # Download data (skipped if unchanged since the last update)
+        bulk_fname = scry.download_bulk_file(force=self.args.force)
+        if bulk_fname is None:
+            print("db-mgr: Default cards already ingested, nothing to update (use --force to override).")
+            return
+
+        # Read data and write in batches as it's parsed
+        data = scry.read_bulk_file(bulk_fname)
+        # temp_path = "database/experiments/data/"
+        # data = pd.read_json(temp_path + os.listdir(temp_path)[-2]).to_dict("records")
 
-        dbfile = self._get_dbfile("db")
+        db = self._open_working_db()
+        db.update_records(data)
 
-        # Download data
-        data = scry.download_default_cards()
-        data = scry.to_dataframe(data)
-        # temp_path = "database/experiments/data/"
-        # data = pd.read_json(temp_path + os.listdir(temp_path)[-2])
+        scry.mark_ingested()
 
-        if dbfile:
-            fname = dbfile.filename
-        else:
-            fname = "etg_v1.db"
+    def backfill(self):
+        """Loads saved json snapshots into database in date order."""
+        if self.args.path is None:
+            self._log_warning("db-mgr: No snapshot folder given to backfill from!")
+            return
 
-        db = ETGDatabase(path + fname)
-        db.update(data)
+        db = self._open_working_db()
+        backfill.backfill(db, self.args.path, self.args.workers)
 
     def increment(self):
         """Creates new version of database by copying."""
@@ -79,40 +100,65 @@ class DBManager:
             # Copy to new and set new as working db
             db.conn.backup(db_new.conn)
             db = db_new
+
+            # Default opens now get the new version, so the old one's cached results are dropped
+            QueryCache().invalidate(path + dbfile.filename)
         else:
             self._log_warning("db-mgr: No database to increment!")
 
+    def movers(self):
+        """Prints the day's biggest price movers across every printing and finish."""
+        dbfile = self._get_dbfile("db")
+
+        if dbfile:
+            db = ETGDatabase("data/db/" + dbfile.filename)
+            df = db.movers(self.args.date, limit=self.args.limit, rank_by=self.args.rank_by)
+
+            with pd.option_context("display.width", 200, "display.max_columns", None):
+                print(df.to_string(index=False))
+        else:
+            self._log_warning("db-mgr: No database to scan!")
+
     def zip(self):
+        """Compresses db with comp_type, in parallel blocks across all cores."""
         dbfile = self._get_dbfile("db")
 
         if dbfile:
-            zip_filename = dbfile.filename.split(".")[0] + ".bz2"
+            zip_filename = dbfile.filename.split(".")[0] + f".{self.comp_type}"
 
-            with open(f"data/db/{dbfile.filename}", "rb") as f_in:
-                with bz2.BZ2File(f"data/zip/{zip_filename}", "wb") as f_out:
-                    f_out.writelines(f_in)
+            # Changes still in the WAL (e.g. from pooled connections) aren't in the file yet
+            pool.checkpoint(f"data/db/{dbfile.filename}")
+
+            stats = compress.compress_file(
+                f"data/db/{dbfile.filename}", f"data/zip/{zip_filename}", self.comp_type, workers=self.args.workers
+            )
+            self._print_compression("Zipped", zip_filename, stats)
         else:
             self._log_warning("db-mgr: No databases to zip!")
 
     def unzip(self):
+        """Uncompresses db, in parallel blocks when it was zipped in blocks."""
         zipfile = self._get_dbfile("zip")
 
         if zipfile:
-            db_filename = zipfile.filename.split(".")[0] + ".db"
-
-            with bz2.BZ2File(f"data/zip/{zipfile.filename}", "rb") as f_in:
-                with open(f"data/db/{db_filename}", "wb") as f_out:
-                    f_out.writelines(f_in)
+            self._unzip_file(zipfile.filename)
         else:
             self._log_warning("db-mgr: No databases to unzip!")
 
     def push(self):
+        """Pushes latest db, as a patch against the version before it with --delta."""
+        storage = remote.open_storage(self.args.storage, self.args.storage_path)
+
+        # Archived months aren't in the database any more, so they go along with it
+        self._push_archives(storage)
+
+        if self.args.delta and self._push_patch(storage):
+            return
+
         self.zip()
 
         path = "data/zip/"
 
-        gcs = GCSConnection()
-
         dbfile = self._get_dbfile("zip")
 
         if dbfile:
@@ -121,34 +167,199 @@ class DBManager:
 
             print(f"db-mgr: Pushing '{fname}' [{fsize:.4f} Mb]...")
 
-            gcs.upload(path + fname, fname)
+            storage.upload(path + fname, fname)
 
             # Delete older versions so only a given number remain
-            gcs.clean(3)
+            storage.clean(3, f".{self.comp_type}")
         else:
             self._log_warning("db-mgr: No zipped databases to push!")
 
     def pull(self):
-        path = "data/zip/"
+        """Pulls latest db, from patches on top of a local version with --delta when possible."""
+        storage = remote.open_storage(self.args.storage, self.args.storage_path)
 
-        gcs = GCSConnection()
+        source_names = storage.get_filenames()
+
+        self._pull_archives(storage, source_names)
+
+        if self.args.delta:
+            version = self._latest_remote_version(source_names)
+            if version is not None and self._pull_patches(storage, source_names, version):
+                return
+
+        path = "data/db/"
 
-        source_names = gcs.get_filenames()
         dbfile = self._get_dbfile(self.comp_type, source_names)
 
         if dbfile:
             fname = dbfile.filename
+            db_filename = fname.split(".")[0] + ".db"
 
             print(f"db-mgr: Pulling '{fname}'...")
 
-            gcs.download(fname, path + fname)
-
-            self.unzip()
+            # Decompressed as it downloads, and only moved into place once the codec checksums and
+            # the stored sha256 match
+            with storage.open(fname) as f_in:
+                stats = compress.decompress_into(f_in, path + db_filename, self.args.workers, self.comp_type, f_in.verify)
+            self._print_compression("Pulled and unzipped", fname, stats)
+
+            # Newer versions only pushed as patches
+            if self.args.delta and self.args.version is None:
+                version = self._latest_remote_version(source_names)
+                if version > dbfile.version:
+                    self._pull_patches(storage, source_names, version, base=dbfile.version)
         else:
             self._log_warning("db-mgr: No databases to pull!")
 
     # Helpers -------------------------
 
+    def _push_archives(self, storage: remote.Storage):
+        """Pushes the monthly price archives (see prices.archive), skipping those already online."""
+        path = "data/db/archive/"
+
+        if not os.path.isdir(path):
+            return
+
+        for fname in sorted(os.listdir(path)):
+            if ARCHIVE_FILENAME.fullmatch(fname):
+                print(f"db-mgr: Pushing archive '{fname}'...")
+                storage.upload(path + fname, "archive/" + fname)
+
+    def _pull_archives(self, storage: remote.Storage, source_names: list[str]):
+        """Pulls the monthly price archives missing here, which pulled databases need for older dates."""
+        path = "data/db/archive/"
+
+        for name in sorted(source_names):
+            fname = name[len("archive/"):]
+            if name.startswith("archive/") and ARCHIVE_FILENAME.fullmatch(fname):
+                print(f"db-mgr: Pulling archive '{fname}'...")
+                os.makedirs(path, exist_ok=True)
+                storage.download(name, path + fname)
+
+    def _push_patch(self, storage: remote.Storage) -> bool:
+        """Pushes latest db as a patch, False if it has to be pushed in full instead."""
+        path = "data/db/"
+
+        dbfile = self._get_dbfile("db")
+        if not dbfile:
+            return False
+
+        base_fname = f"etg_v{dbfile.version - 1}.db"
+        if base_fname not in os.listdir(path):
+            print(f"db-mgr: No '{base_fname}' to make a patch from, pushing in full...")
+            return False
+
+        # Every so often a full copy, so new pullers don't need a long chain of patches
+        names = storage.get_filenames()
+        fulls = [DBFile(name).version for name in names if name.endswith(f".{self.comp_type}")]
+        if not fulls:
+            print("db-mgr: No full copy online to patch from, pushing in full...")
+            return False
+        if dbfile.version - max(fulls) > DELTA_CHAIN:
+            print(f"db-mgr: Last {DELTA_CHAIN} versions online are patches, pushing in full...")
+            return False
+
+        fname = self._patch_filename(dbfile.version, dbfile.version - 1)
+
+        # Both files have to be complete by themselves (see zip)
+        pool.checkpoint(path + base_fname)
+        pool.checkpoint(path + dbfile.filename)
+
+        stats = delta.diff(path + base_fname, path + dbfile.filename, "data/zip/" + fname, self.comp_type, self.args.workers)
+        print(
+            f"db-mgr: Pushing '{fname}' [{stats['changed']}/{stats['pages']} pages changed, "
+            f"{stats['patch_bytes'] / 1024 ** 2:.4f} Mb]..."
+        )
+
+        storage.upload("data/zip/" + fname, fname)
+
+        storage.clean(DELTA_CHAIN, ".patch")
+
+        return True
+
+    def _pull_patches(self, storage: remote.Storage, source_names: list[str], version: int, base: int | None = None) -> bool:
+        """Rebuilds version from patches online on top of base (default the newest local version they lead up from).
+
+        False if there's no such chain of patches or one doesn't check out (e.g. the local version
+        was updated after it was pushed), so it has to be pulled in full instead.
+        """
+        path = "data/db/"
+
+        patches = {}
+        for name in source_names:
+            match = PATCH_FILENAME.fullmatch(name)
+            if match:
+                patches[int(match[1])] = (name, int(match[2]))
+
+        # Walk back from version until a local one
+        local = {DBFile(fname).version for fname in os.listdir(path) if fname.endswith(".db")}
+        chain = []
+        v = version
+        while (v != base) if base is not None else (v not in local):
+            if v not in patches:
+                print(f"db-mgr: No patches online lead to v{version} from a local version, pulling in full...")
+                return False
+
+            fname, base_version = patches[v]
+            chain.append((fname, f"etg_v{base_version}.db", f"etg_v{v}.db"))
+            v = base_version
+
+        if not chain:
+            print(f"db-mgr: Already have v{version}, nothing to pull.")
+
+        for fname, base_fname, new_fname in reversed(chain):
+            print(f"db-mgr: Pulling '{fname}'...")
+            storage.download(fname, "data/zip/" + fname)
+
+            # The base is patched byte for byte, so it has to be complete by itself (see zip)
+            pool.checkpoint(path + base_fname)
+
+            try:
+                stats = delta.apply(path + base_fname, "data/zip/" + fname, path + new_fname, self.args.workers)
+            except ValueError as e:
+                self._log_warning(f"db-mgr: {e} Pulling in full...")
+                return False
+
+            print(f"db-mgr: Patched '{base_fname}' to '{new_fname}' [{stats['changed']}/{stats['pages']} pages]")
+
+        return True
+
+    def _latest_remote_version(self, source_names: list[str]) -> int | None:
+        """Version to pull, the given one or the newest online as a full copy or patch."""
+        if self.args.version is not None:
+            return self.args.version
+
+        versions = [
+            DBFile(name).version
+            for name in source_names
+            if name.endswith(f".{self.comp_type}") or name.endswith(".patch")
+        ]
+
+        return max(versions, default=None)
+
+    def _unzip_file(self, fname: str):
+        db_filename = fname.split(".")[0] + ".db"
+
+        stats = compress.decompress_file(f"data/zip/{fname}", f"data/db/{db_filename}", self.args.workers, self.comp_type)
+        self._print_compression("Unzipped", fname, stats)
+
+    @staticmethod
+    def _patch_filename(version: int, base_version: int) -> str:
+        return f"etg_v{version}_from_v{base_version}.patch"
+
+    def _open_working_db(self):
+        """Opens latest or specific version, creating the first version if there are none."""
+        path = "data/db/"
+
+        dbfile = self._get_dbfile("db")
+
+        if dbfile:
+            fname = dbfile.filename
+        else:
+            fname = "etg_v1.db"
+
+        return ETGDatabase(path + fname)
+
     def _get_dbfile(self, ftype, filenames=None):
         """Gets latest or specific version as DBFile."""
         v = self.args.version
@@ -167,8 +378,8 @@ class DBManager:
         if ftype == "zip":
             ftype = self.comp_type
 
-        # Get newest version
-        files = [DBFile(fname) for fname in filenames if f".{ftype}" in fname]
+        # Get newest version, matching whole names so a db's -wal/-shm files (or a .tmp) aren't picked
+        files = [DBFile(fname) for fname in filenames if re.fullmatch(rf"etg_v\d+\.{re.escape(ftype)}", fname)]
 
         if files:
             latest_file = max(files)
@@ -192,6 +403,14 @@ class DBManager:
 
         return DBFile(fname)
 
+    @staticmethod
+    def _print_compression(action: str, fname: str, stats: dict):
+        print(
+            f"db-mgr: {action} '{fname}' with {stats['codec']} "
+            f"[{stats['raw_bytes'] / 1024 ** 2:.1f} Mb -> {stats['compressed_bytes'] / 1024 ** 2:.1f} Mb, "
+            f"ratio {stats['ratio']:.2f}, {stats['mb_per_s']:.1f} Mb/s]"
+        )
+
     def _log_warning(self, msg: str):
         print(msg)
         self.logger.warning(msg)
@@ -213,8 +432,18 @@ def main():
 
         Examples:
             $ py database/mgr.py update    -- updates latest db and creates new version
+            $ py database/mgr.py update -p -- same, writing cards while the bulk file downloads
             $ py database/mgr.py zip -v 2  -- zip v2 in data/db/ to data/zip/
             $ py database/mgr.py push      -- push latest zipped db to online storage
+            $ py database/mgr.py zip -c xz -- zip latest db with xz instead of bz2
+            $ py database/mgr.py push -s local
+                                           -- push to data/remote/ instead of online storage
+            $ py database/mgr.py push --delta
+                                           -- push only the pages changed since the version before
+            $ py database/mgr.py backfill database/experiments/data/ -j 4
+                                           -- load saved snapshots with 4 parser processes
+            $ py database/mgr.py movers -d 2023-08-27 -n 50
+                                           -- top 50 price movers on the given day
     """)
     # Config argument parser
     parser = argparse.ArgumentParser(
@@ -223,18 +452,43 @@ def main():
     )
     parser.add_argument(
         "command", 
-        choices=["update", "increment", "zip", "unzip", "pull", "push"],
+        choices=["update", "backfill", "movers", "increment", "zip", "unzip", "pull", "push"],
         help=(
             "Select a command for latest (default) or specified (-v) db version:\n"
             "  update    - Downloads daily data and creates/updates a db\n"
+            "  backfill  - Loads saved json snapshots from <path> in date order (resumable)\n"
+            "  movers    - Prints the biggest price movers (% change, z-score, new highs/lows)\n"
             "  increment - Copys db to create a new version\n"
             "  zip       - Compresses db and writes to data/zip/\n"
             "  unzip     - Uncompresses db and writes to data/db/\n"
-            "  push      - Zips and pushes db to online storage (deletes older versions if too many)"
-            "  pull      - Pulls zipped db from online storage and unzips\n"
+            "  push      - Zips and pushes db and its monthly price archives to online storage\n"
+            "              (deletes older versions if too many)\n"
+            "  pull      - Pulls zipped db and missing price archives from online storage, unzipping\n"
+            "              as it downloads\n"
         )
     )
+    parser.add_argument("path", nargs="?", help="backfill: Folder of saved json snapshots")
     parser.add_argument("-v", "--version", type=int, help="Version number to operate on")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="backfill: Number of parser processes, zip/unzip: Number of compression threads "
+                             "(default: cpu count)")
+    parser.add_argument("-c", "--codec", choices=list(compress.CODECS), default="bz2",
+                        help="zip/unzip/push/pull: Compression codec, also the zipped file's extension\n"
+                             "(zst needs the zstandard package)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="update: Download and ingest even if the bulk file is unchanged")
+    parser.add_argument("-s", "--storage", choices=remote.BACKENDS, default="gcs",
+                        help="push/pull: Where databases are stored online, or a local folder for testing")
+    parser.add_argument("--storage-path", help=f"push/pull: Folder of local storage (default: {remote.LocalStorage.PATH})")
+    parser.add_argument("--delta", action="store_true",
+                        help="push/pull: Transfer a patch of changed pages when the other side has the\n"
+                             "version before (falls back to a full copy)")
+    parser.add_argument("-p", "--pipeline", action="store_true",
+                        help="update: Write cards while the rest of the bulk file downloads, reports stage timings")
+    parser.add_argument("-d", "--date", help="movers: Day to scan, YYYY-MM-DD (default: latest)")
+    parser.add_argument("-n", "--limit", type=int, default=25, help="movers: Number of movers to show")
+    parser.add_argument("--rank-by", choices=["pct", "z", "change"], default="pct",
+                        help="movers: What movers are ranked by (absolute value)")
 
     # Config logger
     logging.basicConfig(
@@ -251,7 +505,7 @@ def main():
     # Create manager
     args = parser.parse_args()
     logger = logging.getLogger()
-    mgr = DBManager(args, logger)
+    mgr = DBManager(args, logger, comp_type=args.codec)
 
     # Other init
     cmd = args.command
@@ -261,6 +515,12 @@ def main():
     if cmd == "update":
         print(f"db-mgr: Updating {db_alias}...")
         mgr.update()
+    if cmd == "backfill":
+        print(f"db-mgr: Backfilling {db_alias} from '{args.path}'...")
+        mgr.backfill()
+    if cmd == "movers":
+        print(f"db-mgr: Scanning {db_alias} for movers...")
+        mgr.movers()
     if cmd == "increment":
         print(f"db-mgr: Creating new version of {db_alias}...")
         mgr.increment()
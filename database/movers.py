@@ -0,0 +1,82 @@
+"""Vectorized "what moved" scan over the price cube."""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from database.cube import FINISHES, PriceCube
+from database.tables import prices
+
+# Calendar days of trailing history z-scores are measured against
+WINDOW = 30
+# Prices needed in the window before a z-score is given
+MIN_HISTORY = 5
+# Movers where both prices are below this (in dollars) are left out as noise
+MIN_PRICE = 0.5
+
+RANK_BY = ("pct", "z", "change")
+
+
+def scan(
+    cube: PriceCube,
+    date: str | None = None,
+    window: int = WINDOW,
+    min_price: float = MIN_PRICE,
+    min_history: int = MIN_HISTORY,
+    rank_by: str = "pct",
+) -> pd.DataFrame:
+    """Ranks every printing and finish with a price on date (default latest) and the day before.
+
+    Each row has the price, the previous loaded day's price, the change and percent change, the
+    z-score of the price against the trailing window (NaN with too little history or no variation),
+    and whether it's a new all-time high/low. Rows are ranked by the absolute value of rank_by.
+    """
+    if rank_by not in RANK_BY:
+        raise ValueError(f"Can only rank by one of {RANK_BY}!")
+
+    t = len(cube.days) - 1 if date is None else cube.day_index(date)
+    if t < 1:
+        raise ValueError("Need at least one loaded day before the scanned day!")
+
+    values = cube.values
+    price, prev = values[:, t], values[:, t - 1]
+
+    # Trailing window before the day, and all history before it
+    start = int(np.searchsorted(cube.days, cube.days[t] - window))
+    history = values[:, start:t]
+
+    # All-NaN slices (cards without history) are expected, their results stay NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        counts = np.sum(~np.isnan(history), axis=1)
+        mean = np.nanmean(history, axis=1)
+        std = np.nanstd(history, axis=1)
+        high = np.nanmax(values[:, :t], axis=1)
+        low = np.nanmin(values[:, :t], axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.where((counts >= min_history) & (std > 0), (price - mean) / std, np.nan)
+        pct = 100 * (price - prev) / prev
+
+    # Printing/finish pairs priced on both days
+    keep = ~np.isnan(price) & ~np.isnan(prev) & (prev > 0) & (np.maximum(price, prev) >= min_price)
+    rows, finishes = np.nonzero(keep)
+
+    df = pd.DataFrame({
+        "id": np.asarray(cube.ids, dtype=object)[rows],
+        "finish": np.asarray(FINISHES, dtype=object)[finishes],
+        "price": price[keep],
+        "prev_price": prev[keep],
+        "change": (price - prev)[keep],
+        "pct": pct[keep],
+        "z": z[keep],
+        "new_high": (price > high)[keep],
+        "new_low": (price < low)[keep],
+    })
+
+    order = np.argsort(-np.nan_to_num(np.abs(df[rank_by].to_numpy()), nan=-1), kind="stable")
+    df = df.iloc[order].reset_index(drop=True)
+    df.insert(0, "utc", prices.from_day(int(cube.days[t])).isoformat())
+
+    return df
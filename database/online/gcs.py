@@ -1,38 +1,44 @@
 import os
-import re
 
 from google.cloud import storage
 
+from database.online.storage import Storage
+
+
+class GCSConnection(Storage):
+    """Storage in the etg-data bucket, sha256s are kept in the blobs' metadata."""
+    def __init__(self, bucket_name="etg-data", keypath="database/online/keys/gcs/", **kwargs):
+        super().__init__(**kwargs)
 
-class GCSConnection:
-    def __init__(self):
-        keypath = "database/online/keys/gcs/"
         keyfile = os.listdir(keypath)[-1]
 
         self.client = storage.Client.from_service_account_json(os.path.abspath(keypath + keyfile))
-        self.bucket_name = "etg-data"
+        self.bucket_name = bucket_name
         self.bucket = self.client.bucket(self.bucket_name)
 
-    def download(self, source_bname, dest_fname):
-        blob = self.bucket.blob(source_bname)
-        blob.download_to_filename(dest_fname)
+    def delete(self, name):
+        self.bucket.blob(name).delete()
+
+    def _list(self, prefix=""):
+        return {blob.name: blob.size for blob in self.client.list_blobs(self.bucket, prefix=prefix or None)}
+
+    def _stat(self, name):
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
 
-    def upload(self, source_fname, dest_bname):
-        blob = self.bucket.blob(dest_bname)
+        return blob.size, (blob.metadata or {}).get("sha256")
 
-        with open(source_fname, "rb") as f:
-            blob.upload_from_file(f)
+    def _read(self, name, start, end):
+        # GCS ranges include the end byte
+        return self.bucket.blob(name).download_as_bytes(start=start, end=end - 1) if end > start else b""
 
-    def clean(self, max_files):
-        """Deletes older versions so only <max_files> databases or less remain."""
-        # Get sorted list of filenames
-        fnames = self.get_filenames()
-        fnames = sorted(fnames, key=lambda x: re.split("[_.]", x)[1][1:])
+    def _write(self, name, data):
+        self.bucket.blob(name).upload_from_string(data, content_type="application/octet-stream")
 
-        # Delete older versions
-        if len(fnames) > max_files:
-            for i in range(len(fnames) - max_files):
-                self.bucket.blob(fnames[i]).delete()
+    def _compose(self, name, parts, sha256):
+        blob = self.bucket.blob(name)
+        blob.metadata = {"sha256": sha256}
+        blob.content_type = "application/octet-stream"
 
-    def get_filenames(self):
-        return [blob.name for blob in self.bucket.list_blobs()]
+        blob.compose([self.bucket.blob(part) for part in parts])
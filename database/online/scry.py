@@ -1,37 +1,249 @@
 """Utilities for downloading and processing data via the Scryfall API."""
 
-from typing import Union
+from typing import Callable, Iterable, Iterator, Union
 
+import codecs
 import datetime
+import hashlib
 import json
-from requests import get
+import os
+import time
+from requests import Response, get
+from requests.exceptions import RequestException
 
 import pandas as pd
 
+# Base url of the API, can be pointed at a local stand-in server
+API_URL = os.environ.get("SCRYFALL_API_URL", "https://api.scryfall.com")
+# Where the last downloaded bulk file and its metadata are kept
+CACHE_PATH = "data/cache/"
 
-def download_default_cards() -> dict:
-    """ONLY ONCE A DAY! Downloads default cards and returns response as a dict"""
-    url = "https://api.scryfall.com/bulk-data/default_cards"
+# Bytes read from the response per network read when streaming
+CHUNK_SIZE = 1024 ** 2
 
-    print ("scry: Downloading default cards...")
+# Times a dropped download is resumed before giving up
+RETRIES = 5
+# Seconds to wait on the server before treating the connection as dropped
+TIMEOUT = 60
+# Seconds between download progress reports
+PROGRESS_INTERVAL = 5
 
-    data = get(url)
-    if not data.ok:
-        raise RuntimeError(f"Request failed, got: {data.status_code}")
 
-    try:
-        cards_url = data.json()["download_uri"]
-    except Exception as e:
-        raise RuntimeError(f"Exception loading data url. {e}")
+def download_bulk_file(
+    force: bool = False, cache_path: str = CACHE_PATH, on_chunk: Callable[[bytes], None] | None = None
+) -> str | None:
+    """Downloads default cards to the on-disk cache if Scryfall has regenerated them.
 
-    data = get(cards_url)
-    if not data.ok:
-        raise RuntimeError(f"Request failed, got: {data.status_code}")
+    Returns the path of the bulk file if it has not been ingested yet (or force is set),
+    otherwise None. Unchanged files are revalidated with ETag/If-Modified-Since rather
+    than downloaded again. on_chunk is passed along to download_file, so it only sees the
+    file if it is downloaded.
+    """
+    fpath = cache_path + "default_cards.json"
+    meta = _load_meta(cache_path)
+    cached = os.path.exists(fpath)
+
+    bulk = _get_bulk_metadata()
+
+    # Same bulk file as the last download, nothing to fetch
+    if cached and not force and bulk["updated_at"] == meta.get("updated_at"):
+        print("scry: Default cards unchanged since last download.")
+        return _cached_bulk_file(fpath, meta)
+
+    headers = {}
+    if cached and not force:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    print ("scry: Downloading default cards...")
+
+    # Bulk data gives the decoded size, which the gzip encoded response can't be checked against
+    result = download_file(bulk["download_uri"], fpath, headers, bulk.get("size"), on_chunk=on_chunk)
+    if result is None:
+        print("scry: Default cards not modified.")
+        meta["updated_at"] = bulk["updated_at"]
+        _save_meta(cache_path, meta)
+        return _cached_bulk_file(fpath, meta)
+
+    meta = {
+        "updated_at": bulk["updated_at"],
+        "download_uri": bulk["download_uri"],
+        **result,
+        "ingested": False,
+    }
+    _save_meta(cache_path, meta)
 
     print("scry: Done.")
 
-    # Convert text to dictionary and return
-    return data.json()
+    return fpath
+
+def download_file(
+    url: str,
+    fpath: str,
+    headers: dict | None = None,
+    expected_size: int | None = None,
+    sha256: str | None = None,
+    retries: int = RETRIES,
+    on_chunk: Callable[[bytes], None] | None = None,
+) -> dict | None:
+    """Streams url to fpath in chunks, resuming with Range requests if the connection drops.
+
+    The body is requested gzip encoded and written decoded to '<fpath>.part', which only
+    replaces fpath once its size (and sha256 if given) have been verified. Returns the
+    response's etag/last_modified and the file's size/sha256, or None if the server
+    answered 304 Not Modified to the given headers.
+
+    on_chunk is given the decoded body in order as it is written, each byte once across
+    resumes (a partial file from an earlier run is passed first), so the body can be
+    processed while it downloads. It should not be trusted until this returns.
+    """
+    part = fpath + ".part"
+
+    # Bytes passed to on_chunk so far, counted as they go so a dropped connection can't lose track
+    delivered = 0
+
+    def pass_on(chunk: bytes, position: int):
+        """Passes on the part of a chunk (at position in the body) that hasn't been yet"""
+        nonlocal delivered
+        if position + len(chunk) > delivered:
+            on_chunk(chunk[max(delivered - position, 0):])
+            delivered = position + len(chunk)
+
+    # Only resume a partial file if it came from the same url
+    state = _load_json(part + ".json")
+    if state.get("url") != url and os.path.exists(part):
+        os.remove(part)
+
+    attempt = 0
+    while True:
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+        req_headers = {"Accept-Encoding": "gzip", **(headers or {})}
+        if offset:
+            # Byte offsets refer to the decoded body, so resume without compression
+            req_headers["Accept-Encoding"] = "identity"
+            req_headers["Range"] = f"bytes={offset}-"
+            validator = _range_validator(state)
+            if validator:
+                req_headers["If-Range"] = validator
+
+        try:
+            with get(url, headers=req_headers, stream=True, timeout=TIMEOUT) as data:
+                if data.status_code == 304:
+                    return None
+
+                if data.status_code == 416:
+                    # Stale partial file, start over
+                    os.remove(part)
+                    continue
+
+                # Server errors are retried, anything else is fatal
+                if data.status_code >= 500:
+                    data.raise_for_status()
+                if not data.ok:
+                    raise RuntimeError(f"Request failed, got: {data.status_code}")
+
+                # Server ignored the range (or the file changed), start over
+                if data.status_code != 206:
+                    offset = 0
+
+                    # Bytes already handed on may be from a different file
+                    if on_chunk is not None and delivered and data.headers.get("ETag") != state.get("etag"):
+                        raise RuntimeError("Download restarted with a changed file after it was passed on")
+
+                state = {
+                    "url": url,
+                    "etag": data.headers.get("ETag"),
+                    "last_modified": data.headers.get("Last-Modified"),
+                }
+                _save_json(part + ".json", state)
+
+                size = _expected_size(data, offset)
+                if expected_size is None:
+                    expected_size = size
+                elif size is not None and size != expected_size:
+                    raise RuntimeError(f"Expected {expected_size} bytes, server has {size}")
+
+                _write_response(data, part, offset, expected_size, on_chunk and pass_on, delivered)
+            break
+        except RequestException as e:
+            attempt += 1
+            if attempt > retries:
+                raise RuntimeError(f"Download failed after {retries} retries. {e}")
+
+            delay = min(2 ** attempt, 60)
+            print(f"scry: Download interrupted ({e}), resuming in {delay}s...")
+            time.sleep(delay)
+
+    # Verify before handing the file over
+    result = _verify_file(part, expected_size, sha256)
+    os.replace(part, fpath)
+    os.remove(part + ".json")
+
+    return {"etag": state["etag"], "last_modified": state["last_modified"], **result}
+
+def read_bulk_file(fpath: str) -> Iterator[dict]:
+    """Streams a downloaded bulk file, yielding each card as soon as it is parsed."""
+    with open(fpath, "rb") as infile:
+        chunks = iter(lambda: infile.read(CHUNK_SIZE), b"")
+        yield from iter_records(chunks)
+
+def mark_ingested(cache_path: str = CACHE_PATH):
+    """Records that the cached bulk file has been written to a database."""
+    meta = _load_meta(cache_path)
+    meta["ingested"] = True
+    _save_meta(cache_path, meta)
+
+def iter_records(chunks: Iterable[bytes]) -> Iterator[dict]:
+    """Incrementally parses a JSON array from raw byte chunks, yielding one element at a time."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+
+    buf = ""
+    pos = 0
+    started = False
+    chunks = iter(chunks)
+    eof = False
+
+    while True:
+        # Skip whitespace and separators between elements
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+
+            if buf[pos] == "]":
+                return
+
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Element is split across chunks, read more unless there is nothing left
+                if eof:
+                    raise
+            else:
+                pos = end
+                yield record
+                continue
+        elif eof:
+            raise ValueError("Unexpected end of JSON array")
+
+        # Drop consumed text and read the next chunk
+        buf = buf[pos:]
+        pos = 0
+        try:
+            buf += text.decode(next(chunks))
+        except StopIteration:
+            buf += text.decode(b"", final=True)
+            eof = True
 
 def save_json(data: dict, path: Union[str, None] = None):
     """Save API response dict in a json file"""
@@ -51,3 +263,133 @@ def to_dataframe(data: dict) -> pd.DataFrame:
     df = pd.DataFrame.from_dict(data)
 
     return df
+
+def _get_bulk_metadata() -> dict:
+    """Gets the bulk-data object (download_uri, updated_at, size, ...) for default cards"""
+    url = f"{API_URL}/bulk-data/default_cards"
+
+    data = get(url)
+    if not data.ok:
+        raise RuntimeError(f"Request failed, got: {data.status_code}")
+
+    try:
+        bulk = data.json()
+        missing = {"download_uri", "updated_at"} - bulk.keys()
+    except Exception as e:
+        raise RuntimeError(f"Exception loading data url. {e}")
+
+    if missing:
+        raise RuntimeError(f"Bulk data is missing fields: {missing}")
+
+    return bulk
+
+def _cached_bulk_file(fpath: str, meta: dict) -> str | None:
+    """Returns the cached bulk file if it still needs ingesting, verifying it first"""
+    if meta.get("ingested"):
+        return None
+
+    _verify_file(fpath, meta.get("size"), meta.get("sha256"))
+
+    return fpath
+
+def _write_response(
+    data: Response,
+    fpath: str,
+    offset: int,
+    expected_size: int | None,
+    on_chunk: Callable[[bytes, int], None] | None = None,
+    delivered: int = 0,
+):
+    """Appends the response body to fpath from offset, reporting progress and throughput.
+
+    Passes on_chunk each chunk with its position in the body, from delivered on (reading any
+    before offset back from fpath).
+    """
+    done = offset
+    start = last = time.perf_counter()
+
+    with open(fpath, "r+b" if offset else "wb") as outfile:
+        # Part of the body that was written by an earlier attempt or run
+        if on_chunk is not None and delivered < offset:
+            position = outfile.seek(delivered)
+            for chunk in iter(lambda: outfile.read(min(CHUNK_SIZE, offset - outfile.tell())), b""):
+                on_chunk(chunk, position)
+                position += len(chunk)
+
+        outfile.seek(offset)
+        outfile.truncate()
+
+        for chunk in data.iter_content(chunk_size=CHUNK_SIZE):
+            outfile.write(chunk)
+
+            if on_chunk is not None:
+                on_chunk(chunk, done)
+            done += len(chunk)
+
+            now = time.perf_counter()
+            if now - last >= PROGRESS_INTERVAL:
+                last = now
+                total = f"/{expected_size / 1024 ** 2:.1f}" if expected_size else ""
+                rate = (done - offset) / 1024 ** 2 / (now - start)
+                print(f"scry: {done / 1024 ** 2:.1f}{total} Mb ({rate:.2f} Mb/s)")
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    mb = (done - offset) / 1024 ** 2
+    wire = data.raw.tell() / 1024 ** 2
+    print(f"scry: Received {mb:.1f} Mb ({wire:.1f} Mb transferred) "
+          f"in {elapsed:.1f}s [{mb / elapsed:.2f} Mb/s]")
+
+def _verify_file(fpath: str, expected_size: int | None, sha256: str | None) -> dict:
+    """Checks the size/sha256 of a file, raising if either doesn't match"""
+    size = os.path.getsize(fpath)
+    if expected_size is not None and size != expected_size:
+        raise RuntimeError(f"'{fpath}' is {size} bytes, expected {expected_size}")
+
+    digest = hashlib.sha256()
+    with open(fpath, "rb") as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+
+    if sha256 is not None and digest != sha256:
+        raise RuntimeError(f"'{fpath}' sha256 is {digest}, expected {sha256}")
+
+    return {"size": size, "sha256": digest}
+
+def _expected_size(data: Response, offset: int) -> int | None:
+    """Gets the full decoded size of the body from the response headers if known"""
+    content_range = data.headers.get("Content-Range")
+    if data.status_code == 206 and content_range and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+
+    # Content-Length of an encoded body is the compressed size
+    length = data.headers.get("Content-Length")
+    if data.status_code != 206 and length and "Content-Encoding" not in data.headers:
+        return int(length)
+
+    return None
+
+def _range_validator(state: dict) -> str | None:
+    """Gets a validator for If-Range, which needs a strong ETag or a date"""
+    etag = state.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+
+    return state.get("last_modified")
+
+def _load_meta(cache_path: str) -> dict:
+    return _load_json(cache_path + "default_cards.meta.json")
+
+def _save_meta(cache_path: str, meta: dict):
+    _save_json(cache_path + "default_cards.meta.json", meta)
+
+def _load_json(fpath: str) -> dict:
+    try:
+        with open(fpath) as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return {}
+
+def _save_json(fpath: str, data: dict):
+    with open(fpath, "w") as outfile:
+        json.dump(data, outfile, indent=4)
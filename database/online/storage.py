@@ -0,0 +1,353 @@
+"""Storage backends that DBManager pushes databases to and pulls them from.
+
+Files are transferred in chunks on a thread pool. Uploads write the chunks as part objects and
+join them into the file at the end, downloads fetch byte ranges into a .part file next to the
+destination, so an interrupted transfer of the same content picks up with the chunks that are
+missing. Files are stored with their sha256, and a transfer is skipped when both sides match. A file can
+also be read as a stream, with the chunks after the one being read fetched ahead in parallel.
+"""
+
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_SIZE = 8 * 1024 * 1024
+WORKERS = 8
+# Most parts a file can be joined from (the limit of GCS compose)
+MAX_PARTS = 32
+
+BACKENDS = ("gcs", "local")
+
+
+def open_storage(backend: str = "gcs", path: str | None = None) -> "Storage":
+    """Storage by name, GCS (needs google-cloud-storage and a key) or a local folder"""
+    if backend == "gcs":
+        from database.online.gcs import GCSConnection
+        return GCSConnection()
+    if backend == "local":
+        return LocalStorage(path or LocalStorage.PATH)
+
+    raise ValueError(f"Unknown storage backend '{backend}', choose from {BACKENDS}!")
+
+
+class Storage(ABC):
+    """Base for storage backends, which only implement the primitives below the public methods"""
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, workers: int = WORKERS):
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def get_filenames(self) -> list[str]:
+        return [name for name in self._list() if ".parts/" not in name]
+
+    def upload(self, source_fname: str, dest_bname: str) -> bool:
+        """Uploads source_fname as dest_bname, False if it was already there"""
+        size = os.path.getsize(source_fname)
+        sha256 = file_sha256(source_fname)
+
+        if self._stat(dest_bname) == (size, sha256):
+            print(f"storage: '{dest_bname}' is already uploaded, skipping.")
+            return False
+
+        # Parts are named by content, so only an upload of the same file reuses them
+        chunk_size = max(self.chunk_size, math.ceil(size / MAX_PARTS))
+        prefix = f"{dest_bname}.parts/{sha256[:16]}/"
+        n_parts = max(1, math.ceil(size / chunk_size))
+        parts = [f"{prefix}{i:05d}" for i in range(n_parts)]
+
+        uploaded = self._list(prefix)
+        missing = [
+            i for i, part in enumerate(parts)
+            if uploaded.get(part) != min(chunk_size, size - i * chunk_size)
+        ]
+        if len(missing) < n_parts:
+            print(f"storage: Resuming '{dest_bname}' upload, {n_parts - len(missing)}/{n_parts} parts done.")
+
+        def upload_part(i: int):
+            with open(source_fname, "rb") as f:
+                f.seek(i * chunk_size)
+                self._write(parts[i], f.read(chunk_size))
+
+        self._run(upload_part, missing)
+        self._compose(dest_bname, parts, sha256)
+
+        # Parts of this and of abandoned uploads
+        for part in self._list(f"{dest_bname}.parts/"):
+            self.delete(part)
+
+        return True
+
+    def download(self, source_bname: str, dest_fname: str) -> bool:
+        """Downloads source_bname to dest_fname, False if dest_fname already matches it.
+
+        Raises ValueError if the download doesn't match the stored sha256.
+        """
+        stat = self._stat(source_bname)
+        if stat is None:
+            raise FileNotFoundError(f"There is no '{source_bname}' in storage!")
+        size, sha256 = stat
+
+        if sha256 is not None and os.path.exists(dest_fname) and file_sha256(dest_fname) == sha256:
+            print(f"storage: '{dest_fname}' is already downloaded, skipping.")
+            return False
+
+        part_fname, progress_fname = dest_fname + ".part", dest_fname + ".part.json"
+        chunk_size = self.chunk_size
+        n_chunks = math.ceil(size / chunk_size)
+
+        # Chunks already fetched by an interrupted download of the same content
+        progress = {"sha256": sha256, "size": size, "chunk_size": chunk_size, "done": []}
+        if os.path.exists(part_fname) and os.path.exists(progress_fname):
+            with open(progress_fname) as f:
+                saved = json.load(f)
+            if sha256 is not None and {k: saved.get(k) for k in ("sha256", "size", "chunk_size")} == \
+                    {k: progress[k] for k in ("sha256", "size", "chunk_size")}:
+                progress["done"] = saved["done"]
+                print(f"storage: Resuming '{source_bname}' download, {len(progress['done'])}/{n_chunks} chunks done.")
+
+        done = set(progress["done"])
+        lock = threading.Lock()
+
+        with open(part_fname, "r+b" if done else "wb") as f:
+            f.truncate(size)
+        fd = os.open(part_fname, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+
+        def download_chunk(i: int):
+            start = i * chunk_size
+            data = self._read(source_bname, start, min(start + chunk_size, size))
+            os.pwrite(fd, data, start)
+
+            with lock:
+                progress["done"].append(i)
+                with open(progress_fname, "w") as f:
+                    json.dump(progress, f)
+
+        try:
+            self._run(download_chunk, [i for i in range(n_chunks) if i not in done])
+        finally:
+            os.close(fd)
+
+        if sha256 is not None and file_sha256(part_fname) != sha256:
+            os.remove(part_fname)
+            os.remove(progress_fname)
+            raise ValueError(f"Download of '{source_bname}' doesn't match its checksum!")
+
+        os.replace(part_fname, dest_fname)
+        if os.path.exists(progress_fname):
+            os.remove(progress_fname)
+
+        return True
+
+    def open(self, name: str) -> "RemoteFile":
+        """Opens name for reading as a stream, see RemoteFile"""
+        stat = self._stat(name)
+        if stat is None:
+            raise FileNotFoundError(f"There is no '{name}' in storage!")
+
+        return RemoteFile(self, name, *stat)
+
+    def clean(self, max_files: int, suffix: str | None = None):
+        """Deletes older versions so only <max_files> databases (ending with <suffix>) or less remain."""
+        fnames = [fname for fname in self.get_filenames() if suffix is None or fname.endswith(suffix)]
+        fnames = sorted(fnames, key=lambda x: int(re.split("[_.]", x)[1][1:]))
+
+        for fname in fnames[:max(0, len(fnames) - max_files)]:
+            self.delete(fname)
+
+    # Primitives ----------------------
+
+    @abstractmethod
+    def delete(self, name: str):
+        """Deletes name"""
+
+    @abstractmethod
+    def _list(self, prefix: str = "") -> dict[str, int]:
+        """Names (including parts) starting with prefix and their sizes"""
+
+    @abstractmethod
+    def _stat(self, name: str) -> tuple[int, str | None] | None:
+        """Size and stored sha256 (None if unknown) of name, None if it doesn't exist"""
+
+    @abstractmethod
+    def _read(self, name: str, start: int, end: int) -> bytes:
+        """Bytes start up to (not including) end of name"""
+
+    @abstractmethod
+    def _write(self, name: str, data: bytes):
+        """Writes data as name, replacing it if it exists"""
+
+    @abstractmethod
+    def _compose(self, name: str, parts: list[str], sha256: str):
+        """Joins parts into name, storing its sha256"""
+
+    # Helpers -------------------------
+
+    def _run(self, fn, items: list):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # Raises the first error
+            for _ in executor.map(fn, items):
+                pass
+
+
+class RemoteFile(io.RawIOBase):
+    """Readable stream of a file in storage.
+
+    Chunks are fetched in order by the storage's workers, up to twice as many ahead of the reader
+    as there are workers. verify checks everything read (and the rest of the file) against the
+    stored sha256.
+    """
+
+    def __init__(self, storage: Storage, name: str, size: int, sha256: str | None):
+        super().__init__()
+        self.storage = storage
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+
+        self._executor = ThreadPoolExecutor(max_workers=storage.workers)
+        self._pending = deque()
+        self._next = 0
+        self._buffer = memoryview(b"")
+        self._pos = 0
+        self._sha = hashlib.sha256()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if not self._buffer and not self._fill():
+            return 0
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        self._pos += n
+
+        return n
+
+    def tell(self) -> int:
+        return self._pos
+
+    def verify(self):
+        """Raises ValueError if the file doesn't match its stored sha256 (if there is one)"""
+        # Rest of the file, which the reader may not have needed
+        while self._buffer or self._fill():
+            self._pos += len(self._buffer)
+            self._buffer = memoryview(b"")
+
+        if self.sha256 is not None and self._sha.hexdigest() != self.sha256:
+            raise ValueError(f"Download of '{self.name}' doesn't match its checksum!")
+
+    def close(self):
+        if not self.closed:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        super().close()
+
+    def _fill(self) -> bool:
+        """Moves the next chunk into the buffer, False at the end of the file"""
+        chunk_size = self.storage.chunk_size
+
+        while len(self._pending) < 2 * self.storage.workers and self._next < self.size:
+            start = self._next
+            end = min(start + chunk_size, self.size)
+            self._pending.append(self._executor.submit(self.storage._read, self.name, start, end))
+            self._next = end
+
+        if not self._pending:
+            return False
+
+        data = self._pending.popleft().result()
+        self._sha.update(data)
+        self._buffer = memoryview(data)
+
+        return True
+
+
+class LocalStorage(Storage):
+    """Storage in a local folder, for testing and offline use. sha256s are kept in .sha256/"""
+
+    PATH = "data/remote/"
+
+    def __init__(self, path: str = PATH, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        os.makedirs(os.path.join(path, ".sha256"), exist_ok=True)
+
+    def delete(self, name: str):
+        os.remove(self._path(name))
+        if os.path.exists(self._sha_path(name)):
+            os.remove(self._sha_path(name))
+
+        # Folders left empty by parts
+        folder = os.path.dirname(self._path(name))
+        while os.path.abspath(folder) != os.path.abspath(self.path) and not os.listdir(folder):
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+
+    def _list(self, prefix: str = "") -> dict[str, int]:
+        names = {}
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = [d for d in dirs if d != ".sha256"]
+            for fname in files:
+                name = os.path.relpath(os.path.join(root, fname), self.path).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names[name] = os.path.getsize(os.path.join(root, fname))
+
+        return names
+
+    def _stat(self, name: str) -> tuple[int, str | None] | None:
+        if not os.path.exists(self._path(name)):
+            return None
+
+        sha256 = None
+        if os.path.exists(self._sha_path(name)):
+            with open(self._sha_path(name)) as f:
+                sha256 = f.read().strip()
+
+        return os.path.getsize(self._path(name)), sha256
+
+    def _read(self, name: str, start: int, end: int) -> bytes:
+        with open(self._path(name), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def _write(self, name: str, data: bytes):
+        os.makedirs(os.path.dirname(self._path(name)), exist_ok=True)
+        with open(self._path(name), "wb") as f:
+            f.write(data)
+
+    def _compose(self, name: str, parts: list[str], sha256: str):
+        tmp = self._path(name) + ".tmp"
+        with open(tmp, "wb") as f_out:
+            for part in parts:
+                with open(self._path(part), "rb") as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+
+        os.replace(tmp, self._path(name))
+        os.makedirs(os.path.dirname(self._sha_path(name)), exist_ok=True)
+        with open(self._sha_path(name), "w") as f:
+            f.write(sha256)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _sha_path(self, name: str) -> str:
+        return os.path.join(self.path, ".sha256", name)
+
+
+def file_sha256(fname: str) -> str:
+    sha = hashlib.sha256()
+
+    with open(fname, "rb") as f:
+        while data := f.read(CHUNK_SIZE):
+            sha.update(data)
+
+    return sha.hexdigest()
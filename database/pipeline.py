@@ -0,0 +1,248 @@
+"""Update pipeline that downloads, parses and writes the bulk file at the same time.
+
+Three stages run on their own threads, connected by bounded queues:
+
+    download: streams the bulk file to the cache (see scry.download_bulk_file), passing on chunks
+    parse:    parses cards from the chunks and extracts them into batches of table columns
+    write:    writes the batches in one transaction (see ETGDatabase.update_extracted)
+
+so batches are written while the rest of the file is still arriving. A full queue holds back the
+stage feeding it, which bounds memory. An error in any stage stops the others, and the write is
+rolled back. Network and SQLite release the GIL, so the stages overlap despite being threads.
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, Iterator
+
+from database.db import ETGDatabase
+from database.online import scry
+from database.tables import extract
+
+# Downloaded chunks (of scry.CHUNK_SIZE bytes) waiting to be parsed
+CHUNKS_AHEAD = 32
+# Extracted batches (of extract.BATCH_SIZE cards) waiting to be written
+BATCHES_AHEAD = 2
+
+# Seconds between checks for a stopped pipeline while blocked on a queue
+_POLL = 0.1
+
+
+class Stage:
+    """Timings of a stage, split into time spent working and time blocked on its queues"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.waiting_in = 0.0
+        self.waiting_out = 0.0
+        self.total = 0.0
+
+    def report(self) -> str:
+        return (f"{self.name:<8} {self.total:6.2f}s total, {self.busy:6.2f}s working, "
+                f"{self.waiting_in:6.2f}s waiting for input, {self.waiting_out:6.2f}s waiting to pass on "
+                f"[{self.items} items]")
+
+
+class Channel:
+    """Bounded queue between two stages that records its occupancy.
+
+    Occupancy is sampled on every put, after the item is added.
+    """
+
+    _END = object()
+
+    def __init__(self, name: str, maxsize: int, stop: threading.Event):
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = queue.Queue(maxsize)
+        self._stop = stop
+        self._error = None
+
+        self.puts = 0
+        self.occupancy_sum = 0
+        self.occupancy_max = 0
+        self.full = 0
+
+    def put(self, item, stage: Stage):
+        start = time.perf_counter()
+
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                self._queue.put(item, timeout=_POLL)
+                break
+            except queue.Full:
+                continue
+
+        stage.waiting_out += time.perf_counter() - start
+
+        size = self._queue.qsize()
+        self.puts += 1
+        self.occupancy_sum += size
+        self.occupancy_max = max(self.occupancy_max, size)
+        self.full += size >= self.maxsize
+
+    def close(self, stage: Stage):
+        self.put(self._END, stage)
+
+    def fail(self, e: BaseException):
+        """Passes an error on to the consumer, which raises it instead of taking more items"""
+        self._error = e
+
+    def __call__(self, stage: Stage) -> Iterator:
+        """Yields items until the producer closes the channel, raising the producer's errors"""
+        while True:
+            start = time.perf_counter()
+            while True:
+                if self._stop.is_set():
+                    raise _Stopped()
+                if self._error is not None:
+                    raise self._error
+                try:
+                    item = self._queue.get(timeout=_POLL)
+                    break
+                except queue.Empty:
+                    continue
+            stage.waiting_in += time.perf_counter() - start
+
+            if item is self._END:
+                return
+
+            yield item
+
+    def report(self) -> str:
+        mean = self.occupancy_sum / self.puts if self.puts else 0.0
+        return (f"{self.name:<8} queue: {mean:.1f} mean / {self.occupancy_max} max of {self.maxsize} "
+                f"({self.full}/{self.puts} puts left it full)")
+
+
+def update(
+    db: ETGDatabase,
+    force: bool = False,
+    date: str | None = None,
+    chunks_ahead: int = CHUNKS_AHEAD,
+    batches_ahead: int = BATCHES_AHEAD,
+    batch_size: int = extract.BATCH_SIZE,
+) -> bool:
+    """Downloads the bulk file and writes it to db as it arrives, False if there was nothing new.
+
+    Works like scry.download_bulk_file followed by db.update_records, including skipping a
+    bulk file that was already ingested unless force is set. Prints each stage's timings and
+    each queue's occupancy at the end.
+    """
+    if date is None:
+        date = db._current_date()
+
+    stop = threading.Event()
+    download, parse, write = Stage("download"), Stage("parse"), Stage("write")
+    chunks = Channel("chunks", chunks_ahead, stop)
+    batches = Channel("batches", batches_ahead, stop)
+    fnames = []
+
+    def download_stage():
+        streamed = False
+
+        def on_chunk(chunk: bytes):
+            nonlocal streamed
+            streamed = True
+            chunks.put(chunk, download)
+            download.items += 1
+
+        fname = scry.download_bulk_file(force=force, on_chunk=on_chunk)
+
+        # Already downloaded (not modified, or not ingested yet), read from the cache instead
+        if fname is not None and not streamed:
+            with open(fname, "rb") as infile:
+                for chunk in iter(lambda: infile.read(scry.CHUNK_SIZE), b""):
+                    on_chunk(chunk)
+
+        fnames.append(fname)
+        chunks.close(download)
+
+    def parse_stage():
+        # No chunks when there's nothing new to ingest
+        incoming = chunks(parse)
+        first = next(incoming, None)
+        if first is None:
+            batches.close(parse)
+            return
+
+        records = scry.iter_records(_chain(first, incoming))
+
+        for columns in _counted(extract.iter_extract(records, date, batch_size), parse):
+            batches.put(columns, parse)
+
+        # Parsing stops at the closing bracket, but the download is only good once it has been
+        # verified, so wait for it (raising its error) before letting the writer commit
+        for _ in incoming:
+            pass
+        batches.close(parse)
+
+    threads = [
+        _start(download_stage, download, chunks),
+        _start(parse_stage, parse, batches),
+    ]
+
+    start = time.perf_counter()
+    updated = False
+    try:
+        # Nothing is written (and no card treated as delisted) unless there's at least one batch
+        incoming = batches(write)
+        first = next(incoming, None)
+        if first is not None:
+            db.update_extracted(_counted(_chain(first, incoming), write), date)
+            updated = True
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+        write.total = time.perf_counter() - start
+        write.busy = write.total - write.waiting_in
+
+    if updated:
+        for line in [stage.report() for stage in (download, parse, write)] + [chunks.report(), batches.report()]:
+            print(f"pipeline: {line}")
+
+    if updated and fnames and fnames[0] is not None:
+        scry.mark_ingested()
+
+    return updated
+
+def _start(fn: Callable, stage: Stage, out: Channel) -> threading.Thread:
+    """Runs a stage on a thread, passing its errors on through its output channel"""
+    def run():
+        start = time.perf_counter()
+        try:
+            fn()
+        except _Stopped:
+            pass
+        except BaseException as e:
+            out.fail(e)
+        finally:
+            stage.total = time.perf_counter() - start
+            stage.busy += stage.total - stage.waiting_in - stage.waiting_out
+
+    thread = threading.Thread(target=run, name=f"etg-{stage.name}", daemon=True)
+    thread.start()
+
+    return thread
+
+def _counted(items: Iterator, stage: Stage) -> Iterator:
+    """Counts the items a stage takes from an iterator"""
+    for item in items:
+        stage.items += 1
+        yield item
+
+def _chain(first, rest: Iterator) -> Iterator:
+    yield first
+    yield from rest
+
+
+class _Stopped(Exception):
+    """Raised in a stage when another stage failed"""
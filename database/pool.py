@@ -0,0 +1,159 @@
+"""Pool of read-only sqlite connections plus a single writer, shareable across threads."""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+READERS = 4
+MMAP_SIZE = 256 * 1024 * 1024
+TIMEOUT = 30
+# Files SQLite keeps next to a database, holding changes that aren't in the database file yet
+SIDE_FILES = ("-wal", "-shm", "-journal")
+
+
+class ConnectionPool:
+    """Read-only connections checked out one per reader, and one writer behind a lock.
+
+    The database is put in WAL mode so readers aren't blocked while the writer loads an update.
+    """
+
+    def __init__(
+        self, database: str, readers: int = READERS, mmap_size: int = MMAP_SIZE, timeout: float = TIMEOUT
+    ):
+        if readers < 1:
+            raise ValueError("Need at least one reader connection!")
+
+        self.database = database
+        self.size = readers
+        self.timeout = timeout
+
+        # Writer first, it creates the file and switches it to WAL (which persists in the file)
+        self.writer = sqlite3.connect(database, timeout=timeout, check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode = WAL")
+        self._write_lock = threading.RLock()
+
+        uri = f"file:{quote(os.path.abspath(database))}?mode=ro"
+        self._readers = []
+        self._idle = queue.LifoQueue()
+        for _ in range(readers):
+            conn = sqlite3.connect(uri, uri=True, timeout=timeout, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+            conn.execute("PRAGMA query_only = ON")
+            self._readers.append(conn)
+            self._idle.put(conn)
+
+        self._lock = threading.Lock()
+        self._created = time.perf_counter()
+        self._checkouts = 0
+        self._in_use = 0
+        self._max_in_use = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._busy_time = 0.0
+        self._checked_out = {}
+
+    # Checkout ------------------------
+
+    def acquire(self, timeout: float | None = None) -> sqlite3.Connection:
+        """Checks out a reader, waiting up to timeout (default pool timeout) for one to be free"""
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout if timeout is None else timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No reader connection free after {time.perf_counter() - start:.1f}s!")
+
+        now = time.perf_counter()
+        with self._lock:
+            waited = now - start
+            self._checkouts += 1
+            self._wait_time += waited
+            self._max_wait = max(self._max_wait, waited)
+            self._in_use += 1
+            self._max_in_use = max(self._max_in_use, self._in_use)
+            self._checked_out[id(conn)] = now
+
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        """Returns a reader checked out with acquire"""
+        with self._lock:
+            start = self._checked_out.pop(id(conn), None)
+            if start is None:
+                raise ValueError("Connection isn't checked out from this pool!")
+
+            self._busy_time += time.perf_counter() - start
+            self._in_use -= 1
+
+        # Don't hand the next reader an open transaction
+        if conn.in_transaction:
+            conn.rollback()
+
+        self._idle.put(conn)
+
+    @contextmanager
+    def reader(self, timeout: float | None = None):
+        """Checks out a reader for the duration of the with block"""
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def write(self):
+        """Holds the writer for the duration of the with block (re-entrant in the same thread)"""
+        with self._write_lock:
+            yield self.writer
+
+    # Meta ----------------------------
+
+    def stats(self) -> dict[str, int | float]:
+        """Checkouts, wait times (s) and utilization (busy fraction of reader time since creation)"""
+        with self._lock:
+            now = time.perf_counter()
+            busy = self._busy_time + sum(now - start for start in self._checked_out.values())
+            elapsed = max(now - self._created, 1e-9)
+
+            return {
+                "readers": self.size,
+                "in_use": self._in_use,
+                "max_in_use": self._max_in_use,
+                "checkouts": self._checkouts,
+                "wait_total": self._wait_time,
+                "wait_mean": self._wait_time / self._checkouts if self._checkouts else 0.0,
+                "wait_max": self._max_wait,
+                "utilization": busy / (elapsed * self.size),
+            }
+
+    def close(self):
+        for conn in self._readers:
+            conn.close()
+        self.writer.close()
+
+
+def checkpoint(database: str, timeout: float = TIMEOUT):
+    """Moves everything in database's WAL into the file itself, so the file alone is complete.
+
+    Needed before the file is copied byte for byte (zipped, diffed, ...), since a pool leaves
+    it in WAL mode. Raises RuntimeError if open readers or a writer keep it from finishing.
+    """
+    conn = sqlite3.connect(database, timeout=timeout)
+    try:
+        busy, _, _ = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.close()
+
+    if busy:
+        raise RuntimeError(f"Couldn't checkpoint '{database}', it's in use!")
+
+def remove_side_files(database: str):
+    """Removes database's WAL/shm/journal, which would otherwise be applied to a file replacing it"""
+    for suffix in SIDE_FILES:
+        try:
+            os.remove(database + suffix)
+        except FileNotFoundError:
+            pass
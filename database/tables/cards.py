@@ -1,18 +1,32 @@
 import sqlite3
 
-import pandas as pd
+from database.tables import upsert
 
-def list_to_str(data: pd.DataFrame, column_name: str):
-    return data[column_name].apply(
-        lambda x: ",".join(x) if isinstance(x, list) else None
-    )
+FEATURES = ["id", "name", "set_name", "border_color", "promo_types", "frame_effects"]
 
-def update(data: pd.DataFrame, conn: sqlite3.Connection):
+
+def update(data: dict[str, list], conn: sqlite3.Connection):
+    """Upserts new/changed rows given as column arrays (see extract.extract).
+
+    Returns counts of inserted, changed and unchanged rows.
+    """
     table_name = "Cards"
 
     c = conn.cursor()
 
     # Create table if necessary
+    create(c)
+
+    # Only write rows whose content differs from what's stored
+    counts = upsert.upsert_changed(conn, table_name, FEATURES, data)
+
+    c.close()
+
+    return counts
+
+def create(c: sqlite3.Cursor):
+    table_name = "Cards"
+
     c.execute(f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
             id TEXT,
@@ -21,31 +35,52 @@ def update(data: pd.DataFrame, conn: sqlite3.Connection):
             border_color TEXT,
             promo_types TEXT,
             frame_effects TEXT,
+            row_hash INTEGER,
             PRIMARY KEY (id)
         )
     """)
 
-    features = ["id", "name", "set_name", "border_color",
-                "promo_types", "frame_effects"]
+    # Name/set lookups (see ETGDatabase.get_tables filters) shouldn't scan the table
+    c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_name ON {table_name}(name)")
+    c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_set_name ON {table_name}(set_name)")
 
-    # Get columns needed for table from dataframe
-    df = data.loc[:, features]
+    # Tables created before change detection need the hash column
+    upsert.ensure_hash_column(c.connection, table_name)
 
-    # Convert list features to strings
-    df["promo_types"] = list_to_str(df, "promo_types")
-    df["frame_effects"] = list_to_str(df, "frame_effects")
+def create_search(c: sqlite3.Cursor):
+    """Creates the CardSearch trigram index over Cards name/set_name, filling it from existing rows.
 
-    # Insert DataFrame into a temporary table
-    df.to_sql(f"Temp{table_name}", conn, if_exists="replace", index=False)
+    Triggers keep it in sync with later upserts. Filling in one go is much faster than the triggers,
+    so this is called after the first load's batches rather than before.
+    """
+    if c.execute("SELECT 1 FROM sqlite_master WHERE name = 'CardSearch'").fetchone():
+        return
 
-    # Use SQL to merge the temporary table into the main table
-    feats_sep = ", ".join(features)
-    c.execute(f"""
-        INSERT OR REPLACE INTO {table_name} ({feats_sep})
-        SELECT {feats_sep} FROM TempCards
+    # External content table, so the text itself is only stored in Cards
+    c.execute("""
+        CREATE VIRTUAL TABLE CardSearch USING fts5(
+            name, set_name, content='Cards', content_rowid='rowid', tokenize='trigram'
+        )
     """)
 
-    # Drop the temporary table
-    c.execute(f"DROP TABLE Temp{table_name}")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS Cards_search_insert AFTER INSERT ON Cards BEGIN
+            INSERT INTO CardSearch (rowid, name, set_name) VALUES (new.rowid, new.name, new.set_name);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS Cards_search_delete AFTER DELETE ON Cards BEGIN
+            INSERT INTO CardSearch (CardSearch, rowid, name, set_name)
+            VALUES ('delete', old.rowid, old.name, old.set_name);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS Cards_search_update AFTER UPDATE OF name, set_name ON Cards BEGIN
+            INSERT INTO CardSearch (CardSearch, rowid, name, set_name)
+            VALUES ('delete', old.rowid, old.name, old.set_name);
+            INSERT INTO CardSearch (rowid, name, set_name) VALUES (new.rowid, new.name, new.set_name);
+        END
+    """)
 
-    c.close()
+    # Databases from before the index already have cards
+    c.execute("INSERT INTO CardSearch (CardSearch) VALUES ('rebuild')")
@@ -0,0 +1,144 @@
+import sqlite3
+
+from database.tables import cards, images, prices
+
+FINISHES = ["usd", "usd_foil", "usd_etched"]
+# Days of changes kept, older ones are trimmed after each load
+RETENTION_DAYS = 60
+
+
+def begin(conn: sqlite3.Connection, date: str):
+    """Starts logging the changes written by a load of the given day to ChangeLog.
+
+    Every inserted/changed Cards and Images row and every new price or delisting in PriceHistory
+    gets a ChangeLog row with an increasing seq (never reused), the day, the source table, the
+    op (insert, update or delete) and the card's key (see prices.CardKeys), plus the prices (in
+    cents) for Prices changes. Logging is done by temp triggers on this connection, until end is
+    called.
+    """
+    c = conn.cursor()
+    create(c)
+
+    c.execute("DELETE FROM temp.ChangeDay")
+    c.execute("INSERT INTO temp.ChangeDay (day) VALUES (?)", (prices.to_day(date),))
+
+    c.close()
+
+def end(conn: sqlite3.Connection):
+    """Stops logging (e.g. before archiving, which moves rather than changes prices).
+
+    Rolling back the load's transaction stops logging too.
+    """
+    conn.execute("DELETE FROM temp.ChangeDay")
+
+def trim(conn: sqlite3.Connection, date: str, days: int = RETENTION_DAYS) -> int:
+    """Deletes the changes of days more than the given number of days before date.
+
+    Days only go up with seq, so this deletes a range of seqs. Returns the number of rows deleted.
+    """
+    cutoff = prices.to_day(date) - days
+
+    # First change that's kept, or past the last one if none are
+    first = conn.execute(
+        "SELECT seq FROM ChangeLog WHERE day >= ? ORDER BY seq LIMIT 1", (cutoff,)
+    ).fetchone()
+    if first is None:
+        first = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM ChangeLog").fetchone()
+
+    return conn.execute("DELETE FROM ChangeLog WHERE seq < ?", first).rowcount
+
+def create(c: sqlite3.Cursor):
+    # Tables may not exist yet on the first load, and CardKeys is needed for the keys
+    cards.create(c)
+    images.create(c)
+    prices.create(c)
+
+    finishes = ", ".join(f"{finish} INTEGER" for finish in FINISHES)
+
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS ChangeLog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            day INTEGER NOT NULL,
+            source TEXT NOT NULL,
+            op TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            {finishes}
+        )
+    """)
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS ChangeDay (day INTEGER)")
+
+    # Logs from before keys have the card id on every row
+    columns = [row[1] for row in c.execute("PRAGMA main.table_info(ChangeLog)")]
+    if "id" in columns:
+        _migrate_ids(c)
+
+    # Temp triggers, since they're the only ones that can see the temp tables
+    day = "(SELECT day FROM temp.ChangeDay)"
+    logging = f"WHEN {day} IS NOT NULL"
+    log = "INSERT INTO ChangeLog (day, source, op, key"
+
+    # Cards and Images are written before Prices, so a new card gets its key here (with NOT EXISTS,
+    # since the writing statement's conflict handling would override OR IGNORE)
+    new_key = "(SELECT key FROM main.CardKeys WHERE id = new.id)"
+    for table_name in ("Cards", "Images"):
+        for op in ("insert", "update"):
+            c.execute(f"""
+                CREATE TEMP TRIGGER IF NOT EXISTS {table_name}_log_{op} AFTER {op.upper()} ON main.{table_name}
+                {logging} BEGIN
+                    INSERT INTO CardKeys (id) SELECT new.id WHERE NOT EXISTS {new_key};
+                    {log}) VALUES ({day}, '{table_name}', '{op}', {new_key});
+                END
+            """)
+
+    # New intervals (new card, or a price change) and same day reloads with other prices
+    new_prices = ", ".join(f"new.{finish}" for finish in FINISHES)
+    op = """
+        CASE WHEN EXISTS (
+            SELECT 1 FROM main.PriceHistory WHERE key = new.key AND valid_from < new.valid_from
+        ) THEN 'update' ELSE 'insert' END
+    """
+    c.execute(f"""
+        CREATE TEMP TRIGGER IF NOT EXISTS Prices_log_insert AFTER INSERT ON main.PriceHistory
+        {logging} BEGIN
+            {log}, {", ".join(FINISHES)}) VALUES ({day}, 'Prices', {op}, new.key, {new_prices});
+        END
+    """)
+    c.execute(f"""
+        CREATE TEMP TRIGGER IF NOT EXISTS Prices_log_reload AFTER UPDATE OF {", ".join(FINISHES)}
+        ON main.PriceHistory {logging} BEGIN
+            {log}, {", ".join(FINISHES)}) VALUES ({day}, 'Prices', {op}, new.key, {new_prices});
+        END
+    """)
+
+    # Delistings, i.e. intervals closed (or dropped) by prices.finish for cards missing from the day
+    unseen = "old.key NOT IN (SELECT key FROM temp.SeenKeys)"
+    c.execute(f"""
+        CREATE TEMP TRIGGER IF NOT EXISTS Prices_log_close AFTER UPDATE OF valid_to ON main.PriceHistory
+        {logging} AND old.valid_to = {prices.OPEN} AND {unseen} BEGIN
+            {log}) VALUES ({day}, 'Prices', 'delete', old.key);
+        END
+    """)
+    c.execute(f"""
+        CREATE TEMP TRIGGER IF NOT EXISTS Prices_log_drop AFTER DELETE ON main.PriceHistory
+        {logging} AND old.valid_to = {prices.OPEN} AND {unseen} BEGIN
+            {log}) VALUES ({day}, 'Prices', 'delete', old.key);
+        END
+    """)
+
+def _migrate_ids(c: sqlite3.Cursor):
+    """Replaces the card ids of an older ChangeLog with their keys, keeping the seqs"""
+    print("changes: Migrating ChangeLog to card keys...")
+
+    finishes = ", ".join(FINISHES)
+
+    c.execute("ALTER TABLE ChangeLog RENAME TO ChangeLogIds")
+    create(c)
+    c.execute("INSERT OR IGNORE INTO CardKeys (id) SELECT DISTINCT id FROM ChangeLogIds")
+    c.execute(f"""
+        INSERT INTO ChangeLog (seq, day, source, op, key, {finishes})
+        SELECT l.seq, l.day, l.source, l.op, k.key, {", ".join(f"l.{finish}" for finish in FINISHES)}
+        FROM ChangeLogIds l INNER JOIN CardKeys k USING(id)
+    """)
+    c.execute("DROP TABLE ChangeLogIds")
+
+    print("changes: Done.")
@@ -0,0 +1,83 @@
+"""Single-pass extraction of table columns from raw Scryfall card records."""
+
+from itertools import islice
+from typing import Iterable, Iterator
+
+from database.tables import cards, images, prices
+
+# Records extracted per batch when streaming
+BATCH_SIZE = 10_000
+
+IMAGE_SIZES = images.FEATURES[2:]
+
+
+def extract(records: Iterable[dict], date: str) -> dict[str, dict[str, list]]:
+    """Walks each record once, building the column arrays of every table.
+
+    Only the fields stored in the database are kept, so when records is a lazy
+    iterator each raw record can be freed as soon as it has been visited.
+    """
+    card_cols = {feat: [] for feat in cards.FEATURES}
+    image_cols = {feat: [] for feat in images.FEATURES}
+    price_cols = {feat: [] for feat in prices.FEATURES}
+
+    # Bind appends up front, this is the hot loop of an update
+    c_id, c_name, c_set, c_border, c_promo, c_frame = (card_cols[f].append for f in cards.FEATURES)
+    i_id, i_status = image_cols["id"].append, image_cols["image_status"].append
+    i_sizes = [image_cols[size].append for size in IMAGE_SIZES]
+    p_id, p_utc, p_usd, p_foil, p_etched = (price_cols[f].append for f in prices.FEATURES)
+
+    for record in records:
+        card_id = record["id"]
+
+        # Cards
+        c_id(card_id)
+        c_name(record.get("name"))
+        c_set(record.get("set_name"))
+        c_border(record.get("border_color"))
+        c_promo(_list_to_str(record.get("promo_types")))
+        c_frame(_list_to_str(record.get("frame_effects")))
+
+        # Images
+        i_id(card_id)
+        i_status(record.get("image_status"))
+        uris = record.get("image_uris")
+        if not isinstance(uris, dict):
+            uris = {}
+        for size, append in zip(IMAGE_SIZES, i_sizes):
+            append(uris.get(size))
+
+        # Prices
+        price = record.get("prices")
+        if not isinstance(price, dict):
+            price = {}
+        p_id(card_id)
+        p_utc(date)
+        p_usd(_to_float(price.get("usd")))
+        p_foil(_to_float(price.get("usd_foil")))
+        p_etched(_to_float(price.get("usd_etched")))
+
+    return {"Cards": card_cols, "Images": image_cols, "Prices": price_cols}
+
+def iter_extract(
+    records: Iterable[dict], date: str, batch_size: int = BATCH_SIZE
+) -> Iterator[dict[str, dict[str, list]]]:
+    """Extracts table columns from a stream of records in batches of at most batch_size"""
+    records = iter(records)
+    while True:
+        columns = extract(islice(records, batch_size), date)
+        if not columns["Cards"]["id"]:
+            return
+        yield columns
+
+def _list_to_str(value) -> str | None:
+    return ",".join(value) if isinstance(value, list) else None
+
+def _to_float(value) -> float | None:
+    # Prices come as strings, missing ones as None (or NaN from a DataFrame)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+
+    return None if value != value else value
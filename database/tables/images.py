@@ -1,14 +1,32 @@
 import sqlite3
 
-import pandas as pd
+from database.tables import upsert
 
+FEATURES = ["id", "image_status", "small", "normal", "large", "png", "art_crop", "border_crop"]
 
-def update(data: pd.DataFrame, conn: sqlite3.Connection):
+
+def update(data: dict[str, list], conn: sqlite3.Connection):
+    """Upserts new/changed rows given as column arrays (see extract.extract).
+
+    Returns counts of inserted, changed and unchanged rows.
+    """
     table_name = "Images"
 
     c = conn.cursor()
 
     # Create table if necessary
+    create(c)
+
+    # Only write rows whose content differs from what's stored
+    counts = upsert.upsert_changed(conn, table_name, FEATURES, data)
+
+    c.close()
+
+    return counts
+
+def create(c: sqlite3.Cursor):
+    table_name = "Images"
+
     c.execute(f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
             id TEXT,
@@ -19,26 +37,10 @@ def update(data: pd.DataFrame, conn: sqlite3.Connection):
             png TEXT,
             art_crop TEXT,
             border_crop TEXT,
+            row_hash INTEGER,
             PRIMARY KEY (id)
         )
     """)
 
-    features = ["id", "image_status", "small", "normal", "large", "png", "art_crop", "border_crop"]
-
-    # Get columns need from dataframe
-    df = pd.concat([data.loc[:, ["id", "image_status"]], pd.json_normalize(data.image_uris)], axis=1)
-
-    # Insert DataFrame into a temporary table
-    df.to_sql(f"Temp{table_name}", conn, if_exists="replace", index=False)
-
-    # Use SQL to merge the temporary table into the main table
-    feats_sep = ", ".join(features)
-    c.execute(f"""
-        INSERT OR REPLACE INTO {table_name} ({feats_sep})
-        SELECT {feats_sep} FROM TempImages
-    """)
-
-    # Drop the temporary table
-    c.execute(f"DROP TABLE Temp{table_name}")
-
-    c.close()
+    # Tables created before change detection need the hash column
+    upsert.ensure_hash_column(c.connection, table_name)
@@ -1,38 +1,401 @@
+import datetime
+import os
 import sqlite3
+from typing import Iterable, Iterator
 
-import pandas as pd
+from database.tables import upsert
 
+FEATURES = ["id", "utc", "usd", "usd_foil", "usd_etched"]
 
-def update(data: pd.DataFrame, conn: sqlite3.Connection):
-    table_name = "Prices"
+# Day numbers count days since the Unix epoch
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+# valid_to of intervals that are still current
+OPEN = 2 ** 31 - 1
+# Months of history kept in the working database, older months are archived
+RETENTION_MONTHS = 2
+
+
+def update(data: dict[str, list], conn: sqlite3.Connection):
+    """Records prices given as column arrays (see extract.extract), returns the number of rows written.
+
+    Prices are stored as validity intervals in PriceHistory, keyed by an integer card key
+    (see CardKeys) with prices in integer cents. A card's current interval is extended for
+    free while its prices stay the same, so a row is only written when a price changes.
+    PriceDays lists the days that were loaded, and the Prices view reconstructs the daily
+    (id, utc, usd, usd_foil, usd_etched) series from both.
+
+    All rows must be for the same day, which can't be older than the latest loaded day.
+    Call finish once every row of the day has been recorded.
+    """
+    table_name = "PriceHistory"
+
+    if not data["id"]:
+        return 0
+
+    c = conn.cursor()
+    create(c)
+
+    day = to_day(data["utc"][0])
+    prev = _start_day(c, day)
+
+    # Map ids to integer keys, adding keys for new cards
+    c.executemany("INSERT OR IGNORE INTO CardKeys (id) VALUES (?)", ((id_,) for id_ in data["id"]))
+    keys = upsert.lookup(conn, "CardKeys", "key", data["id"])
+    batch_keys = [keys[id_] for id_ in data["id"]]
+
+    # Remember which cards were seen so finish can close the rest
+    c.executemany("INSERT OR IGNORE INTO temp.SeenKeys (key) VALUES (?)", ((k,) for k in batch_keys))
+
+    current = _open_intervals(c, batch_keys)
+
+    inserts, replaces, closes = [], [], []
+    for key, usd, usd_foil, usd_etched in zip(batch_keys, data["usd"], data["usd_foil"], data["usd_etched"]):
+        values = (to_cents(usd), to_cents(usd_foil), to_cents(usd_etched))
+
+        interval = current.get(key)
+        if interval is None:
+            inserts.append((key, day, *values))
+            continue
+
+        valid_from, old_values = interval
+        if old_values == values:
+            continue
+
+        if valid_from == day:
+            # Reloading the same day with different prices
+            replaces.append((*values, key, day))
+        else:
+            closes.append((prev, key, valid_from))
+            inserts.append((key, day, *values))
+
+    c.executemany(f"UPDATE {table_name} SET valid_to = ? WHERE key = ? AND valid_from = ?", closes)
+    c.executemany(f"""
+        UPDATE {table_name} SET usd = ?, usd_foil = ?, usd_etched = ?
+        WHERE key = ? AND valid_from = ?
+    """, replaces)
+    c.executemany(f"""
+        INSERT INTO {table_name} (key, valid_from, valid_to, usd, usd_foil, usd_etched)
+        VALUES (?, ?, {OPEN}, ?, ?, ?)
+    """, inserts)
+
+    c.close()
+
+    return len(inserts) + len(replaces)
+
+def finish(conn: sqlite3.Connection, date: str) -> int:
+    """Closes the intervals of cards missing from the day's data.
+
+    Returns the number of intervals closed.
+    """
+    table_name = "PriceHistory"
+
+    c = conn.cursor()
+    create(c)
+
+    day = to_day(date)
+    prev = _start_day(c, day)
+
+    # Cards that were only added by an earlier load of this day disappear entirely
+    unseen = "key NOT IN (SELECT key FROM temp.SeenKeys)"
+    c.execute(f"DELETE FROM {table_name} WHERE valid_to = {OPEN} AND valid_from = ? AND {unseen}", (day,))
+    closed = c.rowcount
+    c.execute(f"UPDATE {table_name} SET valid_to = ? WHERE valid_to = {OPEN} AND {unseen}", (prev,))
+    closed += c.rowcount
+
+    c.execute("DELETE FROM temp.SeenKeys")
+
+    c.close()
+
+    return closed
+
+def archive(conn: sqlite3.Connection, path: str, months: int = RETENTION_MONTHS) -> list[str]:
+    """Moves whole months older than the given number of months into per-month archive files.
+
+    The cutoff is relative to the latest loaded day. Each month goes to '<path>/prices_YYYY-MM.db'
+    with the same PriceHistory/PriceDays/CardKeys tables and Prices view, clipped to the month.
+    Must be called outside of a transaction (archives are attached). Returns the months archived.
+    """
+    table_name = "PriceHistory"
 
-    # Manually create a table with a primary key if it doesn't exist
     c = conn.cursor()
+    first, latest = c.execute("SELECT MIN(day), MAX(day) FROM PriceDays").fetchone()
+    if latest is None:
+        return []
+
+    cutoff = _shift_months(from_day(latest), -months)
+
+    archived = []
+    month = from_day(first).replace(day=1)
+    while _month_end(month) <= cutoff:
+        start, end = to_day(month.isoformat()), to_day(_month_end(month).isoformat())
+        name = month.strftime("%Y-%m")
+
+        os.makedirs(path, exist_ok=True)
+        c.execute("ATTACH DATABASE ? AS archive", (archive_file(path, name),))
+        try:
+            _create_history(c, "archive")
+
+            # Copy the month's days and intervals (clipped to the month) with their ids
+            c.execute("""
+                INSERT OR IGNORE INTO archive.PriceDays (day)
+                SELECT day FROM main.PriceDays WHERE day BETWEEN ? AND ?
+            """, (start, end))
+            c.execute(f"""
+                INSERT OR REPLACE INTO archive.{table_name}
+                    (key, valid_from, valid_to, usd, usd_foil, usd_etched)
+                SELECT key, max(valid_from, :start), min(valid_to, :end), usd, usd_foil, usd_etched
+                FROM main.{table_name}
+                WHERE valid_from <= :end AND valid_to >= :start
+            """, {"start": start, "end": end})
+            c.execute(f"""
+                INSERT OR IGNORE INTO archive.CardKeys (key, id)
+                SELECT key, id FROM main.CardKeys
+                WHERE key IN (SELECT key FROM archive.{table_name})
+            """)
+
+            # Drop the month from the working database, clipping intervals that continue past it
+            c.execute(f"DELETE FROM main.{table_name} WHERE valid_to <= ?", (end,))
+            c.execute(f"UPDATE main.{table_name} SET valid_from = ? WHERE valid_from <= ?", (end + 1, end))
+            c.execute("DELETE FROM main.PriceDays WHERE day <= ?", (end,))
+
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            c.execute("DETACH DATABASE archive")
+
+        print(f"prices: Archived {name} to '{archive_file(path, name)}'")
+        archived.append(name)
+        month = _month_end(month) + datetime.timedelta(days=1)
+
+    c.close()
+
+    return archived
+
+def archive_files(path: str, start: str, end: str) -> list[str]:
+    """Lists the archive files of months overlapping the YYYY-MM-DD range"""
+    if not os.path.isdir(path):
+        return []
+
+    first, last = start[:7], end[:7]
+    fnames = sorted(
+        fname for fname in os.listdir(path)
+        if fname.startswith("prices_") and fname.endswith(".db")
+    )
+
+    return [
+        os.path.join(path, fname) for fname in fnames
+        if first <= fname[len("prices_"):-len(".db")] <= last
+    ]
+
+def archive_file(path: str, month: str) -> str:
+    return os.path.join(path, f"prices_{month}.db")
+
+def create(c: sqlite3.Cursor):
+    """Creates the price history tables and Prices view, migrating older layouts"""
+    _create_history(c, "main")
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS SeenKeys (key INTEGER PRIMARY KEY)")
+
+def _create_history(c: sqlite3.Cursor, schema: str):
+    """Creates the price history tables and Prices view in the given (main or attached) schema"""
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.CardKeys (
+            key INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE
+        )
+    """)
     c.execute(f"""
-        CREATE TABLE IF NOT EXISTS {table_name} (
-            id TEXT,
-            utc TEXT,
-            usd REAL,
-            usd_foil REAL,
-            usd_etched REAL,
-            PRIMARY KEY(id, utc)
+        CREATE TABLE IF NOT EXISTS {schema}.PriceDays (
+            day INTEGER PRIMARY KEY
         )
     """)
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.PriceHistory (
+            key INTEGER,
+            valid_from INTEGER,
+            valid_to INTEGER,
+            usd INTEGER,
+            usd_foil INTEGER,
+            usd_etched INTEGER,
+            PRIMARY KEY (key, valid_from)
+        ) WITHOUT ROWID
+    """)
+    c.execute(f"""
+        CREATE INDEX IF NOT EXISTS {schema}.idx_PriceHistory_valid_to
+        ON PriceHistory(valid_to, valid_from)
+    """)
 
-    # Create an index on date if not already done
-    try:
-        c.execute(f"CREATE INDEX idx_{table_name}_utc ON {table_name}(utc)")
-    except sqlite3.OperationalError:
-        pass
+    # Older layouts are migrated before the view is created
+    if schema == "main":
+        _migrate(c)
 
-    # Get columns needed for table from dataframe
-    df = pd.concat([data.loc[:, ["id", "utc"]], pd.json_normalize(data.prices)], axis=1)
-    df = df.drop(["eur", "eur_foil", "tix"], axis=1)
+    # Compatibility view in the original shape, day is kept so ranges can use the primary key
+    c.execute(f"CREATE VIEW IF NOT EXISTS {schema}.Prices AS {_select()}")
 
-    # Append DataFrame data to table
-    df.to_sql(table_name, conn, if_exists='append', index=False)
+def between(schema: str = "main", start: int | None = None, end: int | None = None) -> tuple[str, list]:
+    """(SQL, params) selecting what the Prices view of schema has for days start to end (inclusive).
 
-    # Delete data older than a month
-    c.execute(f"DELETE FROM {table_name} WHERE utc <= datetime('now', '-2 months', 'utc')")
+    Reads the tables directly so the intervals can be bounded as well as the days, which lets
+    PriceHistory be searched by its valid_to index instead of scanned. None leaves a side open.
+    """
+    where, params = [], []
+    if start is not None:
+        where += ["d.day >= ?", "h.valid_to >= ?"]
+        params += [start, start]
+    if end is not None:
+        where += ["d.day <= ?", "h.valid_from <= ?"]
+        params += [end, end]
 
-    c.close()
+    query = _select(f"{schema}.")
+    if where:
+        query += " WHERE " + " AND ".join(where)
+
+    return query, params
+
+def _select(prefix: str = "") -> str:
+    """Body of the Prices view, with prefix (a schema and dot) on its tables"""
+    return f"""
+        SELECT
+            k.id AS id,
+            date(d.day * 86400, 'unixepoch') AS utc,
+            h.usd / 100.0 AS usd,
+            h.usd_foil / 100.0 AS usd_foil,
+            h.usd_etched / 100.0 AS usd_etched,
+            d.day AS day
+        FROM {prefix}PriceDays d
+        INNER JOIN {prefix}PriceHistory h ON h.valid_to >= d.day AND h.valid_from <= d.day
+        INNER JOIN {prefix}CardKeys k ON k.key = h.key
+    """
+
+def _migrate(c: sqlite3.Cursor):
+    """Migrates the layouts that came before PriceHistory"""
+    # Databases from before the compact layout have Prices as a table
+    kind = c.execute("SELECT type FROM sqlite_master WHERE name = 'Prices'").fetchone()
+    if kind is not None and kind[0] == "table":
+        _migrate_table(c)
+
+    # Databases from before the history layout have a PriceData table
+    if c.execute("SELECT 1 FROM sqlite_master WHERE name = 'PriceData'").fetchone():
+        _migrate_data(c)
+
+def to_day(utc: str) -> int:
+    """Converts a YYYY-MM-DD date to a day number"""
+    return datetime.date.fromisoformat(utc[:10]).toordinal() - EPOCH
+
+def from_day(day: int) -> datetime.date:
+    return datetime.date.fromordinal(day + EPOCH)
+
+def to_cents(price: float | None) -> int | None:
+    return None if price is None else round(price * 100)
+
+def _start_day(c: sqlite3.Cursor, day: int) -> int | None:
+    """Registers day as loaded and returns the previously loaded day"""
+    latest = c.execute("SELECT MAX(day) FROM PriceDays").fetchone()[0]
+    if latest is not None and day < latest:
+        raise ValueError("Prices can't be loaded for a day older than the latest loaded day")
+
+    c.execute("INSERT OR IGNORE INTO PriceDays (day) VALUES (?)", (day,))
+
+    return c.execute("SELECT MAX(day) FROM PriceDays WHERE day < ?", (day,)).fetchone()[0]
+
+def _month_end(month: datetime.date) -> datetime.date:
+    """Last day of the month of the given date"""
+    next_month = month.replace(day=28) + datetime.timedelta(days=4)
+    return next_month - datetime.timedelta(days=next_month.day)
+
+def _shift_months(date: datetime.date, months: int) -> datetime.date:
+    """Shifts a date by whole months, clamping the day to the end of the month"""
+    index = date.year * 12 + date.month - 1 + months
+    month = datetime.date(index // 12, index % 12 + 1, 1)
+
+    return min(month + datetime.timedelta(days=date.day - 1), _month_end(month))
+
+def _open_intervals(c: sqlite3.Cursor, keys: list[int]) -> dict[int, tuple]:
+    """Maps each key to the (valid_from, prices) of its current interval"""
+    current = {}
+    for i in range(0, len(keys), upsert.LOOKUP_SIZE):
+        chunk = keys[i:i + upsert.LOOKUP_SIZE]
+        params = ", ".join("?" * len(chunk))
+        for key, valid_from, *values in c.execute(f"""
+            SELECT key, valid_from, usd, usd_foil, usd_etched FROM PriceHistory
+            WHERE valid_to = {OPEN} AND key IN ({params})
+        """, chunk):
+            current[key] = (valid_from, tuple(values))
+
+    return current
+
+def _migrate_table(c: sqlite3.Cursor):
+    """Moves rows of the old (id TEXT, utc TEXT, REAL prices) table into PriceData"""
+    print("prices: Migrating Prices table to compact layout...")
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS PriceData (
+            key INTEGER,
+            day INTEGER,
+            usd INTEGER,
+            usd_foil INTEGER,
+            usd_etched INTEGER,
+            PRIMARY KEY (day, key)
+        ) WITHOUT ROWID
+    """)
+    c.execute("INSERT OR IGNORE INTO CardKeys (id) SELECT DISTINCT id FROM Prices")
+    c.execute("""
+        INSERT OR REPLACE INTO PriceData (key, day, usd, usd_foil, usd_etched)
+        SELECT
+            k.key,
+            CAST(julianday(p.utc) - 2440587.5 AS INTEGER),
+            CAST(round(p.usd * 100) AS INTEGER),
+            CAST(round(p.usd_foil * 100) AS INTEGER),
+            CAST(round(p.usd_etched * 100) AS INTEGER)
+        FROM Prices p INNER JOIN CardKeys k USING(id)
+    """)
+    c.execute("DROP TABLE Prices")
+
+    print("prices: Done.")
+
+def _migrate_data(c: sqlite3.Cursor):
+    """Collapses the daily rows of PriceData into validity intervals"""
+    print("prices: Migrating PriceData to interval history...")
+
+    days = [row[0] for row in c.execute("SELECT DISTINCT day FROM PriceData ORDER BY day")]
+    c.executemany("INSERT OR IGNORE INTO PriceDays (day) VALUES (?)", ((day,) for day in days))
+
+    rows = c.connection.execute("""
+        SELECT key, day, usd, usd_foil, usd_etched FROM PriceData ORDER BY key, day
+    """)
+    c.executemany("""
+        INSERT OR REPLACE INTO PriceHistory (key, valid_from, valid_to, usd, usd_foil, usd_etched)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, _runs(rows, days))
+
+    c.execute("DROP VIEW IF EXISTS Prices")
+    c.execute("DROP TABLE PriceData")
+
+    print("prices: Done.")
+
+def _runs(rows: Iterable[tuple], days: list[int]) -> Iterator[tuple]:
+    """Collapses (key, day, *prices) rows ordered by key and day into interval rows"""
+    next_day = dict(zip(days, days[1:]))
+    latest = days[-1] if days else None
+
+    run = None
+    for key, day, *values in rows:
+        values = tuple(values)
+
+        # Extend the run while the card is present every loaded day with the same prices
+        if run is not None and run[0] == key and next_day.get(run[2]) == day and run[3] == values:
+            run[2] = day
+            continue
+
+        if run is not None:
+            yield _interval(run, latest)
+        run = [key, day, day, values]
+
+    if run is not None:
+        yield _interval(run, latest)
+
+def _interval(run: list, latest: int) -> tuple:
+    # Runs reaching the latest day are still current
+    key, start, end, values = run
+    return (key, start, OPEN if end == latest else end, *values)
@@ -0,0 +1,141 @@
+import sqlite3
+
+from database.tables import prices
+
+# Rolling statistics are kept over these many calendar days, ending on the latest loaded day
+WINDOWS = (7, 30)
+
+FINISHES = ["usd", "usd_foil", "usd_etched"]
+
+
+def update(conn: sqlite3.Connection, date: str):
+    """Brings the summary tables up to the given (just loaded) day without committing.
+
+    LatestPrices holds every card's most recent prices, PriceDeltas the change of each card listed
+    on the day since the previous loaded day, and RollingStats the price sums/counts per finish over
+    the last WINDOWS days. Prices are in cents as in PriceHistory.
+
+    Only the day's prices (and the days leaving each window) are read when the day is newer than
+    the last summarized one, otherwise (first run, or a day loaded again) everything is rebuilt.
+    """
+    c = conn.cursor()
+    create(c)
+
+    day = prices.to_day(date)
+    last = c.execute("SELECT day FROM SummaryDay").fetchone()
+    last = None if last is None else last[0]
+
+    if last is not None and day <= last:
+        for table_name in ("LatestPrices", "PriceDeltas", "RollingStats"):
+            c.execute(f"DELETE FROM {table_name}")
+        last = None
+
+    _update_latest(c, day, last)
+    _update_deltas(c, day)
+    for window in WINDOWS:
+        _update_rolling(c, day, last, window)
+
+    c.execute("DELETE FROM SummaryDay")
+    c.execute("INSERT INTO SummaryDay (day) VALUES (?)", (day,))
+
+    c.close()
+
+def create(c: sqlite3.Cursor):
+    finishes = ", ".join(f"{finish} INTEGER" for finish in FINISHES)
+    prev_finishes = ", ".join(f"prev_{finish} INTEGER" for finish in FINISHES)
+    sums = ", ".join(f"{finish}_sum INTEGER, {finish}_n INTEGER" for finish in FINISHES)
+
+    c.execute("CREATE TABLE IF NOT EXISTS SummaryDay (day INTEGER)")
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS LatestPrices (
+            id TEXT PRIMARY KEY,
+            day INTEGER,
+            {finishes}
+        ) WITHOUT ROWID
+    """)
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS PriceDeltas (
+            id TEXT PRIMARY KEY,
+            day INTEGER,
+            prev_day INTEGER,
+            {finishes},
+            {prev_finishes}
+        ) WITHOUT ROWID
+    """)
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS RollingStats (
+            id TEXT,
+            days INTEGER,
+            {sums},
+            PRIMARY KEY (id, days)
+        ) WITHOUT ROWID
+    """)
+
+def _update_latest(c: sqlite3.Cursor, day: int, last: int | None):
+    """Upserts the latest interval of every card with prices after last (all cards if None)"""
+    since = -1 if last is None else last
+
+    # Intervals still open run up to the day being loaded
+    c.execute(f"""
+        INSERT OR REPLACE INTO LatestPrices (id, day, {", ".join(FINISHES)})
+        SELECT k.id, MIN(h.valid_to, ?), {", ".join(f"h.{finish}" for finish in FINISHES)}
+        FROM PriceHistory h INNER JOIN CardKeys k ON k.key = h.key
+        WHERE h.valid_to > ? AND h.valid_from = (
+            SELECT MAX(valid_from) FROM PriceHistory WHERE key = h.key
+        )
+    """, (day, since))
+
+def _update_deltas(c: sqlite3.Cursor, day: int):
+    """Replaces PriceDeltas with the changes of cards listed on day since the previous loaded day"""
+    prev_day, = c.execute("SELECT MAX(day) FROM PriceDays WHERE day < ?", (day,)).fetchone()
+
+    c.execute("DELETE FROM PriceDeltas")
+    c.execute(f"""
+        INSERT INTO PriceDeltas (id, day, prev_day, {", ".join(FINISHES)}, {", ".join(f"prev_{f}" for f in FINISHES)})
+        SELECT k.id, ?, ?, {", ".join(f"cur.{f}" for f in FINISHES)}, {", ".join(f"prev.{f}" for f in FINISHES)}
+        FROM PriceHistory cur
+        INNER JOIN CardKeys k ON k.key = cur.key
+        LEFT JOIN PriceHistory prev ON prev.key = cur.key AND prev.valid_from <= ? AND prev.valid_to >= ?
+        WHERE cur.valid_to >= ? AND cur.valid_from <= ?
+    """, (day, prev_day, prev_day, prev_day, day, day))
+
+def _update_rolling(c: sqlite3.Cursor, day: int, last: int | None, window: int):
+    """Moves the window from ending on last to ending on day (builds it if last is None)"""
+    first = day - window + 1
+
+    # Days that were in the window ending on last but aren't in the new one
+    if last is not None and last - window + 1 < first:
+        leaving = _window_sums(last - window + 1, min(first - 1, last))
+        updates = ", ".join(f"{f}_sum = RollingStats.{f}_sum - s.{f}_sum, {f}_n = RollingStats.{f}_n - s.{f}_n" for f in FINISHES)
+        c.execute(f"""
+            UPDATE RollingStats SET {updates}
+            FROM ({leaving}) AS s
+            WHERE RollingStats.id = s.id AND RollingStats.days = ?
+        """, (window,))
+
+    # Days added to the window
+    added = _window_sums(first if last is None else max(first, last + 1), day)
+    columns = ", ".join(f"{f}_sum, {f}_n" for f in FINISHES)
+    updates = ", ".join(f"{f}_sum = {f}_sum + excluded.{f}_sum, {f}_n = {f}_n + excluded.{f}_n" for f in FINISHES)
+    c.execute(f"""
+        INSERT INTO RollingStats (id, days, {columns})
+        SELECT id, ?, {columns} FROM ({added}) WHERE true
+        ON CONFLICT (id, days) DO UPDATE SET {updates}
+    """, (window,))
+
+    # Cards with no prices left in the window
+    empty = " AND ".join(f"{f}_n = 0" for f in FINISHES)
+    c.execute(f"DELETE FROM RollingStats WHERE days = ? AND {empty}", (window,))
+
+def _window_sums(start: int, end: int) -> str:
+    """SQL of each card's price sums/counts over the loaded days from start to end (inclusive)"""
+    sums = ", ".join(f"COALESCE(SUM(h.{f}), 0) AS {f}_sum, COUNT(h.{f}) AS {f}_n" for f in FINISHES)
+
+    return f"""
+        SELECT k.id AS id, {sums}
+        FROM PriceDays d
+        INNER JOIN PriceHistory h ON h.valid_to >= d.day AND h.valid_from <= d.day
+        INNER JOIN CardKeys k ON k.key = h.key
+        WHERE d.day BETWEEN {int(start)} AND {int(end)}
+        GROUP BY k.id
+    """
@@ -0,0 +1,69 @@
+"""Change-detecting upserts shared by the catalog tables (Cards, Images)."""
+
+import hashlib
+import sqlite3
+
+# Max ids bound per lookup query (kept under SQLite's variable limit)
+LOOKUP_SIZE = 900
+
+# Stored hash of ids that aren't in the table yet
+_MISSING = object()
+
+
+def row_hash(row: tuple) -> int:
+    """Returns a signed 64-bit content hash of a row, so it fits in an INTEGER column"""
+    content = "\x1f".join("\x00" if value is None else str(value) for value in row)
+    digest = hashlib.blake2b(content.encode(), digest_size=8).digest()
+
+    return int.from_bytes(digest, "big", signed=True)
+
+def ensure_hash_column(conn: sqlite3.Connection, table_name: str):
+    """Adds the row_hash column to tables created before change detection"""
+    cols = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+    if "row_hash" not in cols:
+        conn.execute(f"ALTER TABLE {table_name} ADD COLUMN row_hash INTEGER")
+
+def upsert_changed(
+    conn: sqlite3.Connection, table_name: str, features: list[str], data: dict[str, list]
+) -> dict[str, int]:
+    """Writes only the rows (keyed by id) whose content hash is new or differs from the stored one.
+
+    Returns counts of inserted, changed and unchanged rows.
+    """
+    rows = list(zip(*(data[feat] for feat in features)))
+    hashes = [row_hash(row) for row in rows]
+    stored = lookup(conn, table_name, "row_hash", [row[0] for row in rows])
+
+    counts = {"inserted": 0, "changed": 0, "unchanged": 0}
+    writes = []
+    for row, h in zip(rows, hashes):
+        old = stored.get(row[0], _MISSING)
+        if old == h:
+            counts["unchanged"] += 1
+            continue
+
+        counts["inserted" if old is _MISSING else "changed"] += 1
+        writes.append(row + (h,))
+
+    feats_sep = ", ".join(features + ["row_hash"])
+    params = ", ".join("?" * (len(features) + 1))
+    updates = ", ".join(f"{feat} = excluded.{feat}" for feat in features[1:] + ["row_hash"])
+
+    conn.executemany(f"""
+        INSERT INTO {table_name} ({feats_sep}) VALUES ({params})
+        ON CONFLICT (id) DO UPDATE SET {updates}
+    """, writes)
+
+    return counts
+
+def lookup(conn: sqlite3.Connection, table_name: str, column: str, ids: list[str]) -> dict:
+    """Maps each stored id to the given column, in chunks so each query stays bounded"""
+    stored = {}
+    for i in range(0, len(ids), LOOKUP_SIZE):
+        chunk = ids[i:i + LOOKUP_SIZE]
+        params = ", ".join("?" * len(chunk))
+        stored.update(conn.execute(
+            f"SELECT id, {column} FROM {table_name} WHERE id IN ({params})", chunk
+        ))
+
+    return stored